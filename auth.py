@@ -1,3 +1,8 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Annotated
 
 from fastapi import Depends, HTTPException, status
@@ -6,16 +11,112 @@ import jwt
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
 
+import cache
+import database
 import schemas
 import controllers
+import metrics
 from config import Config
 
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_schema = OAuth2PasswordBearer(tokenUrl="login")
 
-# Updated in the main unit when the login_for_access_token function is called
-local_users: list[schemas.UserSchema]
+# bcrypt releases the GIL, so a thread pool is enough to keep the event loop free while hashing
+password_executor = ThreadPoolExecutor(max_workers=Config.PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+password_tasks_pending = 0
+
+
+class TokenCache:
+    """Bounded cache of validated tokens: sha256 of the token -> (exp timestamp, user).
+
+    Entries expire with the token and are dropped when their user is changed in the users directory.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: OrderedDict[bytes, tuple[float, schemas.UserSchema]] = OrderedDict()
+        self._by_user: dict[str, set[bytes]] = {}
+
+    @staticmethod
+    def _digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> schemas.UserSchema | None:
+        digest = self._digest(token)
+        entry = self._entries.get(digest)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            self._remove(digest)
+            return None
+        self._entries.move_to_end(digest)
+        return entry[1]
+
+    def put(self, token: str, user: schemas.UserSchema, exp: float):
+        digest = self._digest(token)
+        self._entries[digest] = (exp, user)
+        self._entries.move_to_end(digest)
+        self._by_user.setdefault(user.user_name, set()).add(digest)
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, digest: bytes):
+        exp, user = self._entries.pop(digest)
+        digests = self._by_user.get(user.user_name)
+        if digests is not None:
+            digests.discard(digest)
+            if not digests:
+                del self._by_user[user.user_name]
+
+    def drop_user(self, user_name: str):
+        for digest in self._by_user.pop(user_name, set()):
+            self._entries.pop(digest, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._by_user.clear()
+
+
+token_cache = TokenCache(max_size=Config.TOKEN_CACHE_MAX_SIZE)
+
+
+class UserDirectory(cache.ReloadedIndex):
+    """In-memory index of users by user_name and by role, kept in sync by the UserController write methods,
+    so token checks and logins do not touch the database.
+    """
+    def __init__(self, ttl: int):
+        super().__init__(ttl)
+        self._by_name: dict[str, schemas.UserSchema] = {}
+        self._by_role: dict[str, dict[str, schemas.UserSchema]] = {}
+
+    @staticmethod
+    def _role(user: schemas.UserSchema) -> str:
+        return getattr(user.role, "value", user.role)
+
+    def clear(self):
+        self._by_name = {}
+        self._by_role = {}
+        token_cache.clear()
+
+    def put(self, user: schemas.UserSchema):
+        self.remove(user.user_name)
+        self._by_name[user.user_name] = user
+        self._by_role.setdefault(self._role(user), {})[user.user_name] = user
+
+    def remove(self, user_name: str):
+        token_cache.drop_user(user_name)
+        user = self._by_name.pop(user_name, None)
+        if user is not None:
+            self._by_role.get(self._role(user), {}).pop(user_name, None)
+
+    def get(self, user_name: str) -> schemas.UserSchema | None:
+        return self._by_name.get(user_name)
+
+    def with_role(self, role: str) -> list[schemas.UserSchema]:
+        return sorted(self._by_role.get(role, {}).values(), key=lambda user: user.user_name)
+
+
+users_directory = UserDirectory(ttl=Config.USERS_DIRECTORY_TTL_SECONDS)
 
 credentials_exception = HTTPException(
     status_code=status.HTTP_401_UNAUTHORIZED,
@@ -29,6 +130,12 @@ access_exception = HTTPException(
             headers={"WWW-Authenticate": "Bearer"},
         )
 
+password_busy_exception = HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many password checks in progress, try again later",
+            headers={"Retry-After": "1"},
+        )
+
 token_exception = HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Wrong token",
@@ -49,13 +156,34 @@ async def create_access_token(token: schemas.TokenSchema) -> schemas.TokenSchema
         raise token_exception
 
 
+async def _run_password_task(func, *args):
+    """Run bcrypt function in the password executor, rejecting calls when its queue is full"""
+    global password_tasks_pending
+    if password_tasks_pending >= Config.PASSWORD_HASH_MAX_PENDING:
+        raise password_busy_exception
+    password_tasks_pending += 1
+    try:
+        result, elapsed = await asyncio.get_running_loop().run_in_executor(password_executor, _timed, func, *args)
+    finally:
+        password_tasks_pending -= 1
+    metrics.observe_bcrypt(func.__name__, elapsed)
+    return result
+
+
+def _timed(func, *args):
+    """Call in the executor thread, measured there to leave out the wait in the executor queue"""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
 async def verify_password(plain_password, hashed_password):
     """Password hash matching function"""
-    return pwd_context.verify(plain_password, hashed_password)
+    return await _run_password_task(pwd_context.verify, plain_password, hashed_password)
 
 
 async def get_password_hash(password):
-    return pwd_context.hash(password)
+    return await _run_password_task(pwd_context.hash, password)
 
 
 async def verify_token(token) -> dict:
@@ -66,12 +194,18 @@ async def verify_token(token) -> dict:
         raise token_exception
 
 
-async def _get_user(user_name: str):
-    """Function to get user from database"""
-    for user in local_users:
-        if user.user_name == user_name:
-            return user
-    return None
+async def _get_user(user_name: str, refresh: bool = False):
+    """Function to get user from the users directory. Users missing from it (any user when refresh is True)
+    are read from the primary database: they may be created or changed by another server process
+    since the directory was loaded"""
+    user = users_directory.get(user_name)
+    if (user is None or refresh) and user_name:
+        async with database.SessionLocal() as session_db:
+            users = await controllers.UserController(session_db).get(user_name=user_name)
+        if users:
+            user = users[0]
+            users_directory.put(user)
+    return user
 
 
 async def authenticate_user(user_name: str, password: str):
@@ -79,11 +213,19 @@ async def authenticate_user(user_name: str, password: str):
     if not user:
         return False
     if not await verify_password(password, user.hashed_password):
-        return False
+        # The password may be changed by another server process, checked again only when its hash differs
+        fresh_user = await _get_user(user_name, refresh=True)
+        if fresh_user.hashed_password == user.hashed_password or \
+                not await verify_password(password, fresh_user.hashed_password):
+            return False
+        user = fresh_user
     return user
 
 
 async def check_current_user(token: Annotated[str, Depends(oauth2_schema)]) -> schemas.UserSchema:
+    user = token_cache.get(token)
+    if user is not None:
+        return user
     try:
         payload = await verify_token(token)
         user_name: str = payload.get("sub")
@@ -94,6 +236,7 @@ async def check_current_user(token: Annotated[str, Depends(oauth2_schema)]) -> s
     user = await _get_user(user_name)
     if not user:
         raise credentials_exception
+    token_cache.put(token, user, payload["exp"])
     return user
 
 
@@ -111,7 +254,6 @@ async def check_admin_user(current_user: Annotated[schemas.UserSchema, Depends(c
         return current_user
 
 
-async def update_list_users(session_db):
-    global local_users
-    _user = controllers.UserController(session_db)
-    local_users = _user.get()
+async def update_list_users(session_db, force: bool = True):
+    """Reload the users directory from database, if force is False - only when it is stale"""
+    await users_directory.reload(controllers.UserController(session_db).get, force)
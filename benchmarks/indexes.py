@@ -0,0 +1,93 @@
+"""Latency of the dh_tasks lookups of TaskController without and with the indexes of the models.
+
+Seeds a SQLite file with rows tasks (1M by default) of 10k employees, runs the listing and the claim queries
+for random employees, then creates the indexes of TaskModel and runs the same queries again.
+Run from the project root:  python -m benchmarks.indexes [rows] [lookups]
+"""
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import sqlalchemy as sa
+
+import models
+
+EMPLOYEES = 10000
+SEED_BATCH = 100000
+
+
+def make_table(metadata: sa.MetaData) -> sa.Table:
+    # dh_tasks references employees, which is not mapped by the models
+    sa.Table("employees", metadata, sa.Column("id", sa.Integer, primary_key=True))
+    return models.TaskModel.__table__.to_metadata(metadata)
+
+
+def seed(connection, tasks: sa.Table, rows: int):
+    connection.execute(sa.insert(tasks.metadata.tables["employees"]), [{"id": i} for i in range(EMPLOYEES)])
+    for start in range(0, rows, SEED_BATCH):
+        connection.execute(sa.insert(tasks), [
+            {"id_employee": random.randrange(EMPLOYEES), "last_context": "context", "message_text": f"message {i}"}
+            for i in range(start, min(start + SEED_BATCH, rows))
+        ])
+
+
+def queries(tasks: sa.Table) -> dict[str, sa.Select]:
+    """Statements of TaskController.get (page of the employee tasks) and of the claim candidates"""
+    employee = sa.bindparam("id_employee")
+    return {
+        "list page": sa.select(tasks.c.id, tasks.c.id_employee, tasks.c.last_context, tasks.c.message_text).
+        where(tasks.c.id_employee == employee, tasks.c.id > 0).order_by(tasks.c.id).limit(51),
+        "claim candidates": sa.select(tasks.c.id).
+        where(tasks.c.id_employee == employee,
+              sa.or_(tasks.c.claimed_until.is_(None), tasks.c.claimed_until < datetime.utcnow())).
+        order_by(tasks.c.id).limit(10),
+    }
+
+
+def measure(connection, title: str, statements: dict[str, sa.Select], lookups: int):
+    print(title)
+    for name, statement in statements.items():
+        compiled = statement.compile(connection)
+        plan = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", (0,) * len(compiled.positiontup)).all()
+        timings = []
+        for _ in range(lookups):
+            start = time.perf_counter()
+            connection.execute(statement, {"id_employee": random.randrange(EMPLOYEES)}).all()
+            timings.append((time.perf_counter() - start) * 1000)
+        print(f"  {name:<18} p50 {statistics.median(timings):8.3f} ms  max {max(timings):8.3f} ms"
+              f"  plan: {'; '.join(row[-1] for row in plan)}")
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    with tempfile.TemporaryDirectory() as directory:
+        engine = sa.create_engine(f"sqlite:///{directory}/tasks.db")
+        metadata = sa.MetaData()
+        tasks = make_table(metadata)
+        with engine.begin() as connection:
+            for table in metadata.sorted_tables:
+                table.create(connection)
+            for index in tasks.indexes:
+                index.drop(connection)
+            start = time.perf_counter()
+            seed(connection, tasks, rows)
+            print(f"{rows} tasks seeded in {time.perf_counter() - start:.1f} s")
+
+        statements = queries(tasks)
+        with engine.connect() as connection:
+            measure(connection, "Without indexes", statements, lookups)
+        with engine.begin() as connection:
+            for index in tasks.indexes:
+                index.create(connection)
+            connection.exec_driver_sql("ANALYZE")
+        with engine.connect() as connection:
+            measure(connection, f"With {', '.join(index.name for index in tasks.indexes)}", statements, lookups)
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
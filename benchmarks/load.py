@@ -0,0 +1,279 @@
+"""Load test of the API on a seeded local SQLite database.
+
+Boots main.app in process (with its lifespan) against a temporary SQLite database seeded with the given
+volumes and drives a mix of scenarios through httpx.AsyncClient: login bursts, catalogue polling with ETags,
+task inbox polling and bulk task writes with claims. Reports throughput and p50/p95/p99 latency per endpoint,
+then memory allocated per request (tracemalloc peak, measured in a separate sequential pass).
+
+Run from the project root:
+    python -m benchmarks.load --mix default --requests 2000 --concurrency 20
+    python -m benchmarks.load --json current.json --compare baseline.json
+The run fails (exit code 1) when p95 of an endpoint is worse than in the baseline by more than --tolerance.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+MIXES = {
+    "default": {"login": 1, "catalogue": 6, "inbox": 6, "writes": 2},
+    "logins": {"login": 1},
+    "catalogue": {"catalogue": 1},
+    "inbox": {"inbox": 1},
+    "writes": {"writes": 1},
+}
+PASSWORD = "benchmark"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mix", choices=MIXES, default="default")
+    parser.add_argument("--requests", type=int, default=2000, help="number of scenario runs")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--alloc-runs", type=int, default=20, help="sequential runs of every scenario "
+                                                                   "for the allocations, 0 to skip")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--employees", type=int, default=1000)
+    parser.add_argument("--reports", type=int, default=50)
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--rows-per-group", type=int, default=10)
+    parser.add_argument("--tasks", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="save the results to the file")
+    parser.add_argument("--compare", help="results file of the baseline run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p95 growth against the baseline")
+    return parser.parse_args()
+
+
+class Recorder:
+    """Client calls with their latency, status and (when tracemalloc is on) allocated memory by endpoint"""
+    def __init__(self, client):
+        self.client = client
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+        self.allocations: dict[str, list[int]] = {}
+
+    async def call(self, label: str, method: str, url: str, **kwargs):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        response = await self.client.request(method, url, **kwargs)
+        elapsed = time.perf_counter() - start
+        if tracing:
+            self.allocations.setdefault(label, []).append(tracemalloc.get_traced_memory()[1] - before)
+        else:
+            self.latencies.setdefault(label, []).append(elapsed)
+        if response.status_code >= 400:
+            self.errors[label] = self.errors.get(label, 0) + 1
+        return response
+
+
+class Scenarios:
+    """Requests of the clients, one method per scenario of the mixes"""
+    def __init__(self, recorder: Recorder, args, token: str):
+        self.recorder = recorder
+        self.args = args
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.etags: dict[str, str] = {}
+
+    async def login(self):
+        await self.recorder.call("POST /login", "POST", "/login",
+                                 data={"username": f"user{random.randrange(self.args.users)}", "password": PASSWORD})
+
+    async def _poll(self, label: str, url: str, **params):
+        """GET of a catalogue like a client caching responses: with If-None-Match of the previous response"""
+        key = f"{url}?{sorted(params.items())}"
+        headers = dict(self.headers)
+        if key in self.etags:
+            headers["If-None-Match"] = self.etags[key]
+        response = await self.recorder.call(label, "GET", url, params=params, headers=headers)
+        if "etag" in response.headers:
+            self.etags[key] = response.headers["etag"]
+
+    async def catalogue(self):
+        choice = random.randrange(5)
+        if choice == 0:
+            await self._poll("GET /reports/", "/reports/")
+        elif choice == 1:
+            await self._poll("GET /reports/{code_name}", f"/reports/report{random.randrange(self.args.reports)}")
+        elif choice == 2:
+            await self._poll("GET /groups/tree", "/groups/tree")
+        elif choice == 3:
+            await self._poll("GET /group_rows/", "/group_rows/", limit=100)
+        else:
+            command = f"command{random.randrange(self.args.groups * self.args.rows_per_group)}"
+            await self.recorder.call("GET /group_rows/{command_text}", "GET",
+                                     f"/group_rows/{command} argument", headers=self.headers)
+
+    async def inbox(self):
+        params = {"id_employee": random.randrange(self.args.employees)}
+        if random.random() < 0.5:
+            await self.recorder.call("GET /tasks/", "GET", "/tasks/", params={**params, "limit": 50},
+                                     headers=self.headers)
+        else:
+            await self.recorder.call("GET /tasks/poll", "GET", "/tasks/poll", params={**params, "timeout": 0},
+                                     headers=self.headers)
+
+    async def writes(self):
+        id_employee = random.randrange(self.args.employees)
+        await self.recorder.call("POST /tasks/bulk", "POST", "/tasks/bulk", headers=self.headers, json=[
+            {"id_employee": id_employee, "last_context": "benchmark", "message_text": f"message {i}"}
+            for i in range(50)
+        ])
+        claim = await self.recorder.call("POST /tasks/claim", "POST", "/tasks/claim", headers=self.headers,
+                                         params={"id_employee": id_employee, "batch": 10})
+        if claim.status_code == 200 and claim.json()["tasks"]:
+            await self.recorder.call("POST /tasks/ack", "POST", "/tasks/ack", headers=self.headers, json={
+                "claim_token": claim.json()["claim_token"],
+                "ids": [task["id"] for task in claim.json()["tasks"]],
+            })
+
+
+async def seed(args):
+    import sqlalchemy as sa
+
+    import auth
+    import database
+    import models
+
+    # dh_tasks references employees, which is not mapped by the models
+    employees = sa.Table("employees", models.Base.metadata, sa.Column("id", sa.Integer, primary_key=True))
+    hashed_password = auth.pwd_context.hash(PASSWORD)
+    async with database.engine.begin() as connection:
+        await connection.run_sync(models.Base.metadata.create_all)
+        await connection.execute(sa.insert(employees), [{"id": i} for i in range(args.employees)])
+        await connection.execute(sa.insert(models.UserModel), [
+            {"user_name": f"user{i}", "id_employee": i % args.employees, "disabled": False,
+             "password": hashed_password, "role": "admin" if i == 0 else "user"}
+            for i in range(args.users)
+        ])
+        await connection.execute(sa.insert(models.ReportModel), [
+            {"name": f"Report {i}", "description": "benchmark", "code_name": f"report{i}", "file_name": f"r{i}.xlsx"}
+            for i in range(args.reports)
+        ])
+        await connection.execute(sa.insert(models.GroupModel), [
+            {"id": i + 1, "name": f"Group {i}", "description": "benchmark", "code_name": f"group{i}"}
+            for i in range(args.groups)
+        ])
+        await connection.execute(sa.insert(models.GroupRowModel), [
+            {"id_group": i // args.rows_per_group + 1, "name": f"Row {i}", "command_text": f"command{i}",
+             "file_name": f"row{i}.xlsx"}
+            for i in range(args.groups * args.rows_per_group)
+        ])
+        for start in range(0, args.tasks, 10000):
+            await connection.execute(sa.insert(models.TaskModel), [
+                {"id_employee": random.randrange(args.employees), "last_context": "seed", "message_text": f"task {i}"}
+                for i in range(start, min(start + 10000, args.tasks))
+            ])
+
+
+def percentile(values: list[float], share: int) -> float:
+    if len(values) < 2:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[share - 1]
+
+
+def summary(recorder: Recorder, elapsed: float) -> dict:
+    results = {}
+    for label, latencies in sorted(recorder.latencies.items()):
+        allocations = recorder.allocations.get(label)
+        results[label] = {
+            "count": len(latencies),
+            "errors": recorder.errors.get(label, 0),
+            "rps": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "alloc_kib": statistics.mean(allocations) / 1024 if allocations else None,
+        }
+    return results
+
+
+def report(results: dict, elapsed: float):
+    total = sum(result["count"] for result in results.values())
+    print(f"{total} requests in {elapsed:.1f} s, {total / elapsed:.0f} requests/s")
+    print(f"{'endpoint':<32} {'count':>7} {'errors':>6} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'KiB/req':>8}")
+    for label, result in results.items():
+        alloc = f"{result['alloc_kib']:8.1f}" if result["alloc_kib"] is not None else f"{'-':>8}"
+        print(f"{label:<32} {result['count']:>7} {result['errors']:>6} {result['rps']:>8.1f} {result['p50_ms']:>8.2f} "
+              f"{result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f} {alloc}")
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    return [f"{label}: p95 {result['p95_ms']:.2f} ms, baseline {baseline[label]['p95_ms']:.2f} ms"
+            for label, result in results.items()
+            if label in baseline and result["p95_ms"] > baseline[label]["p95_ms"] * (1 + tolerance)]
+
+
+async def run(args) -> dict:
+    import httpx
+
+    random.seed(args.seed)
+    await seed(args)
+    main = importlib.import_module("main")
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=60) as client:
+            response = await client.post("/login", data={"username": "user0", "password": PASSWORD})
+            response.raise_for_status()
+            recorder = Recorder(client)
+            scenarios = Scenarios(recorder, args, response.json()["access_token"])
+            mix = MIXES[args.mix]
+            names, weights = list(mix), list(mix.values())
+            remaining = args.requests
+
+            async def worker():
+                nonlocal remaining
+                while remaining > 0:
+                    remaining -= 1
+                    await getattr(scenarios, random.choices(names, weights)[0])()
+
+            start = time.perf_counter()
+            await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+            elapsed = time.perf_counter() - start
+
+            if args.alloc_runs:
+                # Scenarios pick their endpoints at random, they are repeated until every endpoint has its runs
+                tracemalloc.start()
+                for attempt in range(args.alloc_runs * 20):
+                    if all(len(recorder.allocations.get(label, ())) >= args.alloc_runs
+                           for label in recorder.latencies):
+                        break
+                    await getattr(scenarios, names[attempt % len(names)])()
+                tracemalloc.stop()
+    results = summary(recorder, elapsed)
+    report(results, elapsed)
+    return results
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        # Settings are read when config is imported, so the database is chosen before importing the application
+        os.environ["SUPPORT_DATABASE_URL"] = f"sqlite+aiosqlite:///{directory}/benchmark.db"
+        os.environ.pop("SUPPORT_DATABASE_REPLICA_URLS", None)
+        results = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            failed = regressions(results, json.load(file), args.tolerance)
+        for line in failed:
+            print("REGRESSION", line)
+        if failed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
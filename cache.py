@@ -0,0 +1,137 @@
+import hashlib
+import secrets
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+from config import Config
+
+
+class CacheBackend(ABC):
+    """Interface of the catalogue cache backends.
+
+    Values are grouped by namespace (table name), a write to the table invalidates its whole namespace.
+    get returns None on a miss, so None values are not cached.
+    """
+    def __init__(self):
+        self.hits: dict[str, int] = {}
+        self.misses: dict[str, int] = {}
+
+    @abstractmethod
+    def get(self, namespace: str, key):
+        ...
+
+    @abstractmethod
+    def set(self, namespace: str, key, value):
+        ...
+
+    @abstractmethod
+    def invalidate(self, namespace: str):
+        ...
+
+    @abstractmethod
+    def version(self, namespace: str) -> int:
+        """Counter of the namespace invalidations"""
+
+    def _count(self, namespace: str, hit: bool):
+        counters = self.hits if hit else self.misses
+        counters[namespace] = counters.get(namespace, 0) + 1
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {namespace: {"hits": self.hits.get(namespace, 0), "misses": self.misses.get(namespace, 0)}
+                for namespace in sorted(self.hits.keys() | self.misses.keys())}
+
+
+class LocalCache(CacheBackend):
+    """In-process LRU cache with TTL.
+
+    Stand-in for a shared cache: every server process has its own copy, so writes made by other processes
+    are seen after ttl seconds at most. Invalidation bumps the namespace version, which is a part of the key,
+    so old entries are never read again and are pushed out by the LRU.
+    """
+    def __init__(self, max_size: int, ttl: int):
+        super().__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.versions: dict[str, int] = {}
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, namespace: str, key):
+        full_key = (namespace, self.versions.get(namespace, 0), key)
+        entry = self._entries.get(full_key)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(full_key, None)
+            self._count(namespace, hit=False)
+            return None
+        self._entries.move_to_end(full_key)
+        self._count(namespace, hit=True)
+        return entry[1]
+
+    def set(self, namespace: str, key, value):
+        full_key = (namespace, self.versions.get(namespace, 0), key)
+        self._entries[full_key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(full_key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, namespace: str):
+        self.versions[namespace] = self.versions.get(namespace, 0) + 1
+
+    def version(self, namespace: str) -> int:
+        return self.versions.get(namespace, 0)
+
+
+class ReloadedIndex(ABC):
+    """In-memory index of a table, loaded from the database at startup and kept in sync by the controller
+    write methods through put and remove. The whole index is reloaded only when it is older than ttl seconds,
+    to pick up the changes made by other server processes.
+    """
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._loaded_at = 0.0
+
+    @abstractmethod
+    def clear(self):
+        ...
+
+    @abstractmethod
+    def put(self, item):
+        ...
+
+    def is_stale(self) -> bool:
+        return time.monotonic() - self._loaded_at > self.ttl
+
+    def load(self, items: list):
+        self.clear()
+        for item in items:
+            self.put(item)
+        self._loaded_at = time.monotonic()
+
+    async def reload(self, fetch: Callable[[], Awaitable[list]], force: bool = True):
+        """Load the items returned by fetch, if force is False - only when the index is stale"""
+        if force or self.is_stale():
+            self.load(await fetch())
+
+
+backends = {
+    "local": LocalCache,
+}
+
+# Cache of the reports, groups and group rows catalogues
+catalog_cache: CacheBackend = backends[Config.CACHE_BACKEND](max_size=Config.CACHE_MAX_SIZE,
+                                                             ttl=Config.CACHE_TTL_SECONDS)
+
+# Version counters of different server processes are not comparable, so every process signs its ETags
+_etag_epoch = secrets.token_hex(4)
+
+
+def etag(namespace: str, resource: str) -> str:
+    """Strong ETag of a catalogue resource (path with query string).
+
+    Changes on every write to the table made through this process and at least once per ttl
+    to pick up writes made by other processes, like the cached values do.
+    """
+    window = int(time.time() // Config.CACHE_TTL_SECONDS)
+    state = f"{namespace}:{catalog_cache.version(namespace)}:{window}:{resource}"
+    return f'"{_etag_epoch}-{hashlib.blake2b(state.encode(), digest_size=8).hexdigest()}"'
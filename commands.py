@@ -0,0 +1,85 @@
+import cache
+import schemas
+import controllers
+from config import Config
+
+
+def command_key(command_text: str) -> str:
+    """Commands are matched case-insensitive and without surrounding spaces"""
+    return command_text.strip().casefold()
+
+
+class CommandRouter(cache.ReloadedIndex):
+    """In-memory index of group rows by command_text for the bot dispatch, kept in sync by the GroupRowController
+    write methods.
+
+    Exact commands are found by a dict, commands with arguments ("/report 2024") by a character trie of
+    the commands, both in O(len(command)) without touching the database.
+    """
+    def __init__(self, ttl: int):
+        super().__init__(ttl)
+        # Rows by id for every command key, several rows may have the same command - the first one is used
+        self._by_command: dict[str, dict[int, schemas.GroupRowSchema]] = {}
+        self._keys: dict[int, str] = {}
+        # Nested dicts by character, the None key marks the end of a command
+        self._trie: dict = {}
+
+    def clear(self):
+        self._by_command = {}
+        self._keys = {}
+        self._trie = {}
+
+    def put(self, group_row: schemas.GroupRowSchema):
+        self.remove(group_row.id)
+        key = command_key(group_row.command_text)
+        rows = self._by_command.setdefault(key, {})
+        if not rows:
+            node = self._trie
+            for char in key:
+                node = node.setdefault(char, {})
+            node[None] = key
+        rows[group_row.id] = group_row
+        self._keys[group_row.id] = key
+
+    def remove(self, _id: int):
+        key = self._keys.pop(_id, None)
+        if key is None:
+            return
+        rows = self._by_command[key]
+        del rows[_id]
+        if rows:
+            return
+        del self._by_command[key]
+        # Drop the end mark and the branches left empty
+        nodes = [self._trie]
+        for char in key:
+            nodes.append(nodes[-1][char])
+        del nodes[-1][None]
+        for depth in range(len(key), 0, -1):
+            if nodes[depth]:
+                break
+            del nodes[depth - 1][key[depth - 1]]
+
+    def match(self, text: str) -> schemas.GroupRowSchema | None:
+        """Row of the command: the exact command or the longest command followed by arguments"""
+        key = command_key(text)
+        rows = self._by_command.get(key)
+        if rows is None:
+            node = self._trie
+            for position, char in enumerate(key):
+                node = node.get(char)
+                if node is None:
+                    break
+                if None in node and position + 1 < len(key) and key[position + 1].isspace():
+                    rows = self._by_command[node[None]]
+        if rows:
+            return rows[min(rows)]
+        return None
+
+
+command_router = CommandRouter(ttl=Config.COMMAND_ROUTER_TTL_SECONDS)
+
+
+async def update_command_router(session_db, force: bool = True):
+    """Reload the command router from database, if force is False - only when it is stale"""
+    await command_router.reload(controllers.GroupRowController(session_db).get, force)
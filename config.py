@@ -1,12 +1,108 @@
+import os
 import pathlib
+from urllib.parse import quote_plus
 
 BASE_DIR = pathlib.Path(__file__).parent
 
+
+def _env(name: str, default, cast=str):
+    """Setting from the SUPPORT_<name> environment variable"""
+    value = os.environ.get(f"SUPPORT_{name}")
+    return default if value is None else cast(value)
+
+
+def _flag(value: str) -> bool:
+    return value.lower() in ("1", "true", "yes", "on")
+
+
+def _mapping(value: str) -> dict[str, str]:
+    """Dict from the comma separated key=value pairs"""
+    return {key.strip(): item.strip() for key, item in (pair.split("=", 1) for pair in value.split(",") if "=" in pair)}
+
+
 class Config:
-    CONNECT_STRING = "Driver={SQL Server Native Client 11.0};Server=DESKTOP-255RLKB\SQLEXPRESS;Database=support;" \
-                     "Trusted_Connection=yes"
+    CONNECT_STRING = _env("CONNECT_STRING",
+                          "Driver={SQL Server Native Client 11.0};Server=DESKTOP-255RLKB\SQLEXPRESS;Database=support;"
+                          "Trusted_Connection=yes")
+    # SQLAlchemy URL of the database, by default the ODBC CONNECT_STRING is used.
+    # DATABASE_REPLICA_URLS - comma separated URLs of the servers for the read-only traffic
+    DATABASE_URL = _env("DATABASE_URL", f"mssql+aioodbc:///?odbc_connect={quote_plus(CONNECT_STRING)}")
+    DATABASE_REPLICA_URLS = _env("DATABASE_REPLICA_URLS", [DATABASE_URL],
+                                 lambda value: [url.strip() for url in value.split(",") if url.strip()])
+    # Replica choice: round_robin or least_busy (fewest connections in use), pause of a replica after
+    # a connection error, and period after a write of the client when its reads go to the primary
+    REPLICA_STRATEGY = _env("REPLICA_STRATEGY", "round_robin")
+    REPLICA_RETRY_SECONDS = _env("REPLICA_RETRY_SECONDS", 30, int)
+    READ_YOUR_WRITES_SECONDS = _env("READ_YOUR_WRITES_SECONDS", 5, int)
+    # Connection pools of the write and the read engines
+    DB_POOL_SIZE = _env("DB_POOL_SIZE", 10, int)
+    DB_READ_POOL_SIZE = _env("DB_READ_POOL_SIZE", 20, int)
+    DB_MAX_OVERFLOW = _env("DB_MAX_OVERFLOW", 10, int)
+    DB_POOL_TIMEOUT_SECONDS = _env("DB_POOL_TIMEOUT_SECONDS", 30, int)
+    DB_POOL_RECYCLE_SECONDS = _env("DB_POOL_RECYCLE_SECONDS", 1800, int)
+    DB_POOL_PRE_PING = _env("DB_POOL_PRE_PING", True, _flag)
+    # pyodbc fast_executemany of the bulk updates on SQL Server, off until it is checked against the server
+    DB_FAST_EXECUTEMANY = _env("DB_FAST_EXECUTEMANY", False, _flag)
+    # DB_ECHO logs every statement and is expensive, instead the given share of statements
+    # slower than DB_SLOW_QUERY_SECONDS is logged
+    DB_ECHO = _env("DB_ECHO", False, _flag)
+    DB_SLOW_QUERY_SECONDS = _env("DB_SLOW_QUERY_SECONDS", 0.5, float)
+    DB_SLOW_QUERY_SAMPLE_RATE = _env("DB_SLOW_QUERY_SAMPLE_RATE", 1.0, float)
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     JWT_SECRET_KEY = "mysecretkey"
     JWT_ALGORITHM = "HS256"
     JWT_EXPIRATION_TIME_MINUTES = 30
-    # SQLALCHEMY_ECHO = True
+    # Lifetime of the in-memory user directory and the bot command router before they are reloaded from the database
+    USERS_DIRECTORY_TTL_SECONDS = 300
+    COMMAND_ROUTER_TTL_SECONDS = 300
+    # Threads hashing and verifying passwords outside the event loop and the max number of queued operations
+    PASSWORD_HASH_WORKERS = 4
+    PASSWORD_HASH_MAX_PENDING = 64
+    # Max number of validated tokens kept to skip JWT decoding of repeated requests
+    TOKEN_CACHE_MAX_SIZE = 10000
+    # Max page size of the list endpoints
+    PAGE_MAX_LIMIT = 1000
+    # Rows fetched from the server-side cursor at once in NDJSON streaming mode
+    STREAM_BATCH_SIZE = 500
+    # Cache of the reports, groups and group rows catalogues: backend name, max number of entries and their lifetime
+    CACHE_BACKEND = "local"
+    CACHE_MAX_SIZE = 1024
+    CACHE_TTL_SECONDS = 60
+    # Max number of items of the bulk endpoints and number of ids sent in one IN (...) condition
+    BULK_MAX_ITEMS = 10000
+    BULK_CHUNK_SIZE = 1000
+    # Directory of the report and group row files (file_name is relative to it), the files up to
+    # FILES_CACHE_MAX_FILE_BYTES are kept in memory, FILES_CACHE_MAX_BYTES in total
+    FILES_ROOT = _env("FILES_ROOT", BASE_DIR / "files", lambda value: BASE_DIR / value)
+    FILES_CACHE_MAX_BYTES = 64 * 1024 * 1024
+    FILES_CACHE_MAX_FILE_BYTES = 1024 * 1024
+    # Report generation jobs: worker processes, jobs of one report running at once and finished jobs kept
+    # for GET /jobs/{id}. Generators by report code_name are dotted paths of functions generator(path, **params)
+    # writing the report to the path (SUPPORT_REPORT_GENERATORS="code_name=package.module.function,...")
+    REPORT_WORKERS = _env("REPORT_WORKERS", 2, int)
+    REPORT_CONCURRENCY_PER_REPORT = _env("REPORT_CONCURRENCY_PER_REPORT", 1, int)
+    REPORT_JOBS_MAX_KEPT = 1000
+    REPORT_GENERATORS = _env("REPORT_GENERATORS", {}, _mapping)
+    # Pushing of the new tasks: max number of tasks waiting for one listener (when exceeded the listener
+    # reads them from the database), period of the database reads picking up the tasks created by other server
+    # processes and max wait of the long-poll request
+    TASK_STREAM_QUEUE_SIZE = 1000
+    # Ids of the sent tasks kept by a WebSocket stream, the tasks committed out of id order within them are not lost
+    TASK_STREAM_SENT_IDS = 1000
+    TASK_STREAM_RESYNC_SECONDS = _env("TASK_STREAM_RESYNC_SECONDS", 30, int)
+    TASK_POLL_MAX_SECONDS = 30
+    # Claims of the tasks by workers: max batch and default and max time the claimed tasks are hidden
+    TASK_CLAIM_MAX_BATCH = 100
+    TASK_CLAIM_VISIBILITY_SECONDS = 60
+    TASK_CLAIM_MAX_VISIBILITY_SECONDS = 3600
+    # Metrics of the requests at GET /metrics (Prometheus text format), SERVER_TIMING adds the timings
+    # of the request (database, pool checkout wait, bcrypt) to the Server-Timing response header
+    METRICS_ENABLED = _env("METRICS_ENABLED", True, _flag)
+    METRICS_SERVER_TIMING = _env("METRICS_SERVER_TIMING", True, _flag)
+    METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    METRICS_QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+    # Profiling of the slow requests, enabled at runtime by an admin (POST /profiling): max time it stays
+    # enabled, slow requests kept with their SQL statements and statements kept per request
+    PROFILING_MAX_SECONDS = 3600
+    PROFILING_MAX_REQUESTS = 100
+    PROFILING_MAX_STATEMENTS = 200
@@ -1,18 +1,61 @@
 import os
-from sqlalchemy import update, delete, and_, select, literal
+import secrets
+from datetime import datetime, timedelta
+from typing import AsyncIterator
+
+from sqlalchemy import Row, update, delete, insert, and_, or_, select, literal
 
 import auth
+import cache
+import commands
+import inbox
 import models
+import pagination
 import schemas
+from config import Config
+from database import reads_primary
+
+
+def _chunks(items: list, size: int = Config.BULK_CHUNK_SIZE):
+    """Split ids for IN (...) conditions, SQL Server accepts at most 2100 parameters in a statement"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+async def _existing_ids(db_session, id_column, ids: list[int]) -> set[int]:
+    existing = set()
+    for chunk in _chunks(list(set(ids))):
+        existing.update((await db_session.scalars(select(id_column).where(id_column.in_(chunk)))).all())
+    return existing
 
 
 class UserController:
     """Data Access Layer and business logic for operating user"""
+    # Columns of the read queries by the schema field name
+    columns = {
+        "user_name": models.UserModel.user_name,
+        "disabled": models.UserModel.disabled,
+        "role": models.UserModel.role,
+        "hashed_password": models.UserModel.password.label("hashed_password"),
+    }
+
     def __init__(self, db_session):
         self.db_session = db_session
 
-    def create(self, user: schemas.UserSchemaCreate) -> schemas.UserSchema:
-        hashed_password = auth.pwd_context.hash(user.password)
+    async def get_page(self, page: pagination.PageParams, **filters) -> tuple[list[Row], str | None]:
+        where = pagination.equal_filters(models.UserModel, filters)
+        query = pagination.page_query(self.columns, "user_name", page, *where)
+        rows = (await self.db_session.execute(query)).all()
+        return pagination.split_page(rows, "user_name", page)
+
+    async def stream(self, page: pagination.PageParams, **filters) -> AsyncIterator[dict]:
+        where = pagination.equal_filters(models.UserModel, filters)
+        query = pagination.page_query(self.columns, "user_name", page, *where)
+        async for row in pagination.stream_rows(self.db_session, query, page.limit):
+            yield row
+
+    async def create(self, user: schemas.UserSchemaCreate) -> schemas.UserSchema:
+        hashed_password = await auth.get_password_hash(user.password)
 
         new_user = models.UserModel(
             user_name=user.user_name,
@@ -22,66 +65,93 @@ class UserController:
             role="user",
         )
         self.db_session.add(new_user)
-        self.db_session.commit()
-        self.db_session.refresh(new_user)
-        return schemas.UserSchema(
+        await self.db_session.commit()
+        await self.db_session.refresh(new_user)
+        user = schemas.UserSchema(
             user_name=new_user.user_name,
             disabled=new_user.disabled,
             role=new_user.role,
             hashed_password=new_user.password,
         )
+        auth.users_directory.put(user)
+        return user
 
-    def get(self, user_name: str = "") -> list[schemas.UserSchema]:
+    async def get(self, user_name: str = "") -> list[schemas.UserSchema]:
+        query = select(*self.columns.values())
         if user_name != "":
-            users = self.db_session.query(models.UserModel).filter(models.UserModel.user_name == user_name).all()
+            query = query.where(models.UserModel.user_name == user_name)
         else:
-            users = self.db_session.query(models.UserModel).order_by(models.UserModel.user_name).all()
+            query = query.order_by(models.UserModel.user_name)
+        users = (await self.db_session.execute(query)).all()
+        return [schemas.UserSchema(**user._asdict()) for user in users]
 
-        if users is not None:
-            return [schemas.UserSchema(user_name=user.user_name,
-                                       disabled=user.disabled,
-                                       role=user.role,
-                                       hashed_password=user.password,
-                                       )
-                    for user in users]
-
-    def delete(self, user_name: str) -> schemas.UserSchema | None:
+    async def delete(self, user_name: str) -> schemas.UserSchema | None:
         query = update(models.UserModel).\
             where(models.UserModel.user_name == user_name).\
             values(disabled=True).\
             returning(models.UserModel)
-        deleted_user_name_rec = self.db_session.execute(query).fetchone()
-        self.db_session.commit()
+        deleted_user_name_rec = (await self.db_session.scalars(query)).first()
+        await self.db_session.commit()
         if deleted_user_name_rec is not None:
-            return schemas.UserSchema(user_name=str(deleted_user_name_rec[0].user_name),
-                                      disabled=str(deleted_user_name_rec[0].disabled),
-                                      role=str(deleted_user_name_rec[0].role),
-                                      hashed_password=str(deleted_user_name_rec[0].hashed_password),
+            user = schemas.UserSchema(user_name=deleted_user_name_rec.user_name,
+                                      disabled=deleted_user_name_rec.disabled,
+                                      role=deleted_user_name_rec.role,
+                                      hashed_password=deleted_user_name_rec.password,
                                       )
+            auth.users_directory.put(user)
+            return user
 
-    def update(self, user_name: str, **kwargs) -> schemas.UserSchemaUpdate | None:
-        kwargs['password'] = auth.pwd_context.hash(kwargs['password'])
+    async def update(self, user_name: str, **kwargs) -> schemas.UserSchemaUpdate | None:
+        if kwargs.get('password') is not None:
+            kwargs['password'] = await auth.get_password_hash(kwargs['password'])
 
         query = update(models.UserModel). \
             where(models.UserModel.user_name == user_name). \
             values(kwargs). \
             returning(models.UserModel)
-        update_user_name_rec = self.db_session.execute(query).fetchone()
-        self.db_session.commit()
+        update_user_name_rec = (await self.db_session.scalars(query)).first()
+        await self.db_session.commit()
         if update_user_name_rec is not None:
-            return schemas.UserSchemaUpdate(id_employee=update_user_name_rec[0].id_employee,
-                                            disabled=update_user_name_rec[0].disabled,
-                                            role=update_user_name_rec[0].role,
-                                            hashed_password=update_user_name_rec[0].password,
+            auth.users_directory.put(schemas.UserSchema(user_name=update_user_name_rec.user_name,
+                                                        disabled=update_user_name_rec.disabled,
+                                                        role=update_user_name_rec.role,
+                                                        hashed_password=update_user_name_rec.password,
+                                                        ))
+            return schemas.UserSchemaUpdate(id_employee=update_user_name_rec.id_employee,
+                                            disabled=update_user_name_rec.disabled,
+                                            role=update_user_name_rec.role,
+                                            password=None,
                                             )
 
 
 class ReportController:
     """Data Access Layer and business logic for operating report"""
+    cache_namespace = models.ReportModel.__tablename__
+    # Columns of the read queries by the schema field name
+    columns = {
+        "id": models.ReportModel.id,
+        "name": models.ReportModel.name,
+        "description": models.ReportModel.description,
+        "code_name": models.ReportModel.code_name,
+        "file_name": models.ReportModel.file_name,
+    }
+
     def __init__(self, db_session):
         self.db_session = db_session
 
-    def create(self, report: schemas.ReportSchemaCreate) -> schemas.ReportSchema:
+    async def get_page(self, page: pagination.PageParams, **filters) -> tuple[list[Row], str | None]:
+        where = pagination.equal_filters(models.ReportModel, filters)
+        query = pagination.page_query(self.columns, "id", page, *where)
+        rows = (await self.db_session.execute(query)).all()
+        return pagination.split_page(rows, "id", page)
+
+    async def stream(self, page: pagination.PageParams, **filters) -> AsyncIterator[dict]:
+        where = pagination.equal_filters(models.ReportModel, filters)
+        query = pagination.page_query(self.columns, "id", page, *where)
+        async for row in pagination.stream_rows(self.db_session, query, page.limit):
+            yield row
+
+    async def create(self, report: schemas.ReportSchemaCreate) -> schemas.ReportSchema:
         new_report = models.ReportModel(
             name=report.name,
             description=report.description,
@@ -89,8 +159,9 @@ class ReportController:
             file_name=report.file_name,
         )
         self.db_session.add(new_report)
-        self.db_session.commit()
-        self.db_session.refresh(new_report)
+        await self.db_session.commit()
+        cache.catalog_cache.invalidate(self.cache_namespace)
+        await self.db_session.refresh(new_report)
         return schemas.ReportSchema(id=new_report.id,
                                     name=new_report.name,
                                     description=new_report.description,
@@ -98,35 +169,32 @@ class ReportController:
                                     file_name=new_report.file_name,
                                     )
 
-    def get(self, code_name: str = "", _id: int = 0) -> list[schemas.ReportSchema]:
+    async def get(self, code_name: str = "", _id: int = 0) -> list[schemas.ReportSchema]:
+        cache_key = (code_name, _id)
+        reports = cache.catalog_cache.get(self.cache_namespace, cache_key)
+        if reports is not None:
+            return reports
+
+        query = select(*self.columns.values())
         if code_name:
-            reports = self.db_session.query(models.ReportModel).\
-                filter(models.ReportModel.code_name == code_name).\
-                all()
+            query = query.where(models.ReportModel.code_name == code_name)
         elif _id:
-            reports = self.db_session.query(models.ReportModel).\
-                filter(models.ReportModel.id == _id).\
-                all()
+            query = query.where(models.ReportModel.id == _id)
         else:
-            reports = self.db_session.query(models.ReportModel).\
-                order_by(models.ReportModel.id).\
-                all()
-
-        if reports is not None:
-            return [schemas.ReportSchema(id=report.id,
-                                         name=report.name,
-                                         description=report.description,
-                                         code_name=report.code_name,
-                                         file_name=report.file_name,
-                                         )
-                    for report in reports]
-
-    def delete(self, _id: int) -> schemas.ReportSchema | None:
+            query = query.order_by(models.ReportModel.id)
+        reports = [schemas.ReportSchema(**report._asdict()) for report in (await self.db_session.execute(query))]
+        # A lagging replica may miss the latest write, its rows would be served from the cache to the writer too
+        if reads_primary(self.db_session):
+            cache.catalog_cache.set(self.cache_namespace, cache_key, reports)
+        return reports
+
+    async def delete(self, _id: int) -> schemas.ReportSchema | None:
         query = delete(models.ReportModel).\
             where(models.ReportModel.id == _id).\
             returning(models.ReportModel)
-        deleted_report_rec = self.db_session.execute(query).fetchone()
-        self.db_session.commit()
+        deleted_report_rec = (await self.db_session.scalars(query)).first()
+        await self.db_session.commit()
+        cache.catalog_cache.invalidate(self.cache_namespace)
         if deleted_report_rec is not None:
             return schemas.ReportSchema(id=deleted_report_rec.id,
                                         name=deleted_report_rec.name,
@@ -135,70 +203,138 @@ class ReportController:
                                         file_name=deleted_report_rec.file_name,
                                         )
 
-    def update(self, _id: int, **kwargs) -> schemas.ReportSchema | None:
+    async def update(self, _id: int, **kwargs) -> schemas.ReportSchema | None:
         query = update(models.ReportModel). \
             where(models.ReportModel.id == _id). \
             values(kwargs). \
             returning(models.ReportModel)
-        update_report_rec = self.db_session.execute(query).fetchone()
-        self.db_session.commit()
+        update_report_rec = (await self.db_session.scalars(query)).first()
+        await self.db_session.commit()
+        cache.catalog_cache.invalidate(self.cache_namespace)
         if update_report_rec is not None:
-            return schemas.ReportSchema(id=update_report_rec[0].id,
-                                        name=update_report_rec[0].name,
-                                        description=update_report_rec[0].description,
-                                        code_name=update_report_rec[0].code_name,
-                                        file_name=update_report_rec[0].file_name,
+            return schemas.ReportSchema(id=update_report_rec.id,
+                                        name=update_report_rec.name,
+                                        description=update_report_rec.description,
+                                        code_name=update_report_rec.code_name,
+                                        file_name=update_report_rec.file_name,
                                         )
 
 
+    async def update_many(self, reports: list[schemas.ReportSchemaBulkUpdate]) -> list[schemas.BulkItemResultSchema]:
+        """Update reports by id in one transaction (executemany), missing reports are reported as not found"""
+        existing = await _existing_ids(self.db_session, models.ReportModel.id, [report.id for report in reports])
+        values = [report.model_dump(exclude_unset=True, exclude_none=True) for report in reports if report.id in existing]
+        if values:
+            await self.db_session.execute(update(models.ReportModel), values)
+            await self.db_session.commit()
+            cache.catalog_cache.invalidate(self.cache_namespace)
+        return [schemas.BulkItemResultSchema(index=index,
+                                             ok=report.id in existing,
+                                             id=report.id,
+                                             detail=None if report.id in existing else
+                                             f"Report with _id {report.id} not found.",
+                                             )
+                for index, report in enumerate(reports)]
+
+
 class GroupController:
     """Data Access Layer and business logic for operating groups"""
+    cache_namespace = models.GroupModel.__tablename__
+    # Groups with their rows, invalidated by writes to both tables
+    tree_cache_namespace = "groups_tree"
+    # Columns of the read queries by the schema field name
+    columns = {
+        "id": models.GroupModel.id,
+        "name": models.GroupModel.name,
+        "description": models.GroupModel.description,
+        "code_name": models.GroupModel.code_name,
+    }
+
     def __init__(self, db_session):
         self.db_session = db_session
 
-    def create(self, group: schemas.GroupSchemaCreate) -> schemas.GroupSchema:
+    async def get_page(self, page: pagination.PageParams, **filters) -> tuple[list[Row], str | None]:
+        where = pagination.equal_filters(models.GroupModel, filters)
+        query = pagination.page_query(self.columns, "id", page, *where)
+        rows = (await self.db_session.execute(query)).all()
+        return pagination.split_page(rows, "id", page)
+
+    async def stream(self, page: pagination.PageParams, **filters) -> AsyncIterator[dict]:
+        where = pagination.equal_filters(models.GroupModel, filters)
+        query = pagination.page_query(self.columns, "id", page, *where)
+        async for row in pagination.stream_rows(self.db_session, query, page.limit):
+            yield row
+
+    async def get_tree(self, code_name: str = "") -> list[schemas.GroupWithRowsSchema]:
+        """Groups with their rows, loaded in two column queries"""
+        tree = cache.catalog_cache.get(self.tree_cache_namespace, code_name)
+        if tree is not None:
+            return tree
+
+        query = select(*self.columns.values()).\
+            order_by(models.GroupModel.id)
+        if code_name:
+            query = query.where(models.GroupModel.code_name == code_name)
+        groups = [group._asdict() for group in (await self.db_session.execute(query))]
+
+        rows_by_group = {group["id"]: [] for group in groups}
+        if groups:
+            query = select(*GroupRowController.columns.values()).\
+                order_by(models.GroupRowModel.id)
+            if code_name:
+                query = query.where(models.GroupRowModel.id_group.in_(list(rows_by_group)))
+            for group_row in (await self.db_session.execute(query)):
+                if group_row.id_group in rows_by_group:
+                    rows_by_group[group_row.id_group].append(schemas.GroupRowSchema(**group_row._asdict()))
+
+        tree = [schemas.GroupWithRowsSchema(**group, rows=rows_by_group[group["id"]]) for group in groups]
+        if reads_primary(self.db_session):
+            cache.catalog_cache.set(self.tree_cache_namespace, code_name, tree)
+        return tree
+
+    async def create(self, group: schemas.GroupSchemaCreate) -> schemas.GroupSchema:
         new_group = models.GroupModel(
             name=group.name,
             description=group.description,
             code_name=group.code_name,
         )
         self.db_session.add(new_group)
-        self.db_session.commit()
-        self.db_session.refresh(new_group)
+        await self.db_session.commit()
+        cache.catalog_cache.invalidate(self.cache_namespace)
+        cache.catalog_cache.invalidate(GroupController.tree_cache_namespace)
+        await self.db_session.refresh(new_group)
         return schemas.GroupSchema(id=new_group.id,
                                    name=new_group.name,
                                    description=new_group.description,
                                    code_name=new_group.code_name,
                                    )
 
-    def get(self, code_name: str = "", _id: int = 0) -> list[schemas.GroupSchema]:
+    async def get(self, code_name: str = "", _id: int = 0) -> list[schemas.GroupSchema]:
+        cache_key = (code_name, _id)
+        groups = cache.catalog_cache.get(self.cache_namespace, cache_key)
+        if groups is not None:
+            return groups
+
+        query = select(*self.columns.values())
         if code_name:
-            groups = self.db_session.query(models.GroupModel).\
-                filter(models.GroupModel.code_name == code_name).\
-                all()
+            query = query.where(models.GroupModel.code_name == code_name)
         elif _id:
-            groups = self.db_session.query(models.GroupModel).\
-                filter(models.GroupModel.id == _id).\
-                all()
+            query = query.where(models.GroupModel.id == _id)
         else:
-            groups = self.db_session.query(models.GroupModel).\
-                order_by(models.GroupModel.id).\
-                all()
-
-        if groups is not None:
-            return [schemas.GroupSchema(id=group.id,
-                                        name=group.name,
-                                        description=group.description,
-                                        code_name=group.code_name,
-                                        )
-                    for group in groups]
+            query = query.order_by(models.GroupModel.id)
+        groups = [schemas.GroupSchema(**group._asdict()) for group in (await self.db_session.execute(query))]
+        if reads_primary(self.db_session):
+            cache.catalog_cache.set(self.cache_namespace, cache_key, groups)
+        return groups
 
-    def delete(self, _id: int) -> schemas.GroupSchema | None:
+    async def delete(self, _id: int) -> schemas.GroupSchema | None:
         query = delete(models.GroupModel).\
             where(models.GroupModel.id == _id).\
             returning(models.GroupModel)
-        deleted_group = self.db_session.execute(query).fetchone()
-        self.db_session.commit()
+        deleted_group = (await self.db_session.scalars(query)).first()
+        await self.db_session.commit()
+        cache.catalog_cache.invalidate(self.cache_namespace)
+        cache.catalog_cache.invalidate(GroupController.tree_cache_namespace)
         if deleted_group is not None:
             return schemas.GroupSchema(id=deleted_group.id,
                                        name=deleted_group.name,
@@ -206,27 +342,51 @@ class GroupController:
                                        code_name=deleted_group.code_name,
                                        )
 
-    def update(self, _id: int, **kwargs) -> schemas.GroupSchema | None:
+    async def update(self, _id: int, **kwargs) -> schemas.GroupSchema | None:
         query = update(models.GroupModel). \
             where(models.GroupModel.id == _id). \
             values(kwargs). \
             returning(models.GroupModel)
-        update_group_rec = self.db_session.execute(query).fetchone()
-        self.db_session.commit()
+        update_group_rec = (await self.db_session.scalars(query)).first()
+        await self.db_session.commit()
+        cache.catalog_cache.invalidate(self.cache_namespace)
+        cache.catalog_cache.invalidate(GroupController.tree_cache_namespace)
         if update_group_rec is not None:
-            return schemas.GroupSchema(id=update_group_rec[0].id,
-                                       name=update_group_rec[0].name,
-                                       description=update_group_rec[0].description,
-                                       code_name=update_group_rec[0].code_name,
+            return schemas.GroupSchema(id=update_group_rec.id,
+                                       name=update_group_rec.name,
+                                       description=update_group_rec.description,
+                                       code_name=update_group_rec.code_name,
                                        )
 
 
 class GroupRowController:
     """Data Access Layer and business logic for operating group rows"""
+    cache_namespace = models.GroupRowModel.__tablename__
+    # Columns of the read queries by the schema field name
+    columns = {
+        "id": models.GroupRowModel.id,
+        "id_group": models.GroupRowModel.id_group,
+        "name": models.GroupRowModel.name,
+        "command_text": models.GroupRowModel.command_text,
+        "file_name": models.GroupRowModel.file_name,
+    }
+
     def __init__(self, db_session):
         self.db_session = db_session
 
-    def create(self, group_row: schemas.GroupRowSchemaCreate) -> schemas.GroupRowSchema:
+    async def get_page(self, page: pagination.PageParams, **filters) -> tuple[list[Row], str | None]:
+        where = pagination.equal_filters(models.GroupRowModel, filters)
+        query = pagination.page_query(self.columns, "id", page, *where)
+        rows = (await self.db_session.execute(query)).all()
+        return pagination.split_page(rows, "id", page)
+
+    async def stream(self, page: pagination.PageParams, **filters) -> AsyncIterator[dict]:
+        where = pagination.equal_filters(models.GroupRowModel, filters)
+        query = pagination.page_query(self.columns, "id", page, *where)
+        async for row in pagination.stream_rows(self.db_session, query, page.limit):
+            yield row
+
+    async def create(self, group_row: schemas.GroupRowSchemaCreate) -> schemas.GroupRowSchema:
         new_group_row = models.GroupRowModel(
             id_group=group_row.id_group,
             name=group_row.name,
@@ -234,43 +394,41 @@ class GroupRowController:
             file_name=group_row.file_name,
         )
         self.db_session.add(new_group_row)
-        self.db_session.commit()
-        self.db_session.refresh(new_group_row)
-        return schemas.GroupRowSchema(id=new_group_row.id,
-                                      id_group=new_group_row.id_group,
-                                      name=new_group_row.name,
-                                      command_text=new_group_row.command_text,
-                                      file_name=new_group_row.file_name,
-                                      )
+        await self.db_session.commit()
+        cache.catalog_cache.invalidate(self.cache_namespace)
+        cache.catalog_cache.invalidate(GroupController.tree_cache_namespace)
+        await self.db_session.refresh(new_group_row)
+        created_group_row = schemas.GroupRowSchema(id=new_group_row.id,
+                                                   id_group=new_group_row.id_group,
+                                                   name=new_group_row.name,
+                                                   command_text=new_group_row.command_text,
+                                                   file_name=new_group_row.file_name,
+                                                   )
+        commands.command_router.put(created_group_row)
+        return created_group_row
+
+    async def get(self, id_group: int = 0, command_text: str = "", _id: int = 0) -> list[schemas.GroupRowSchema]:
+        cache_key = (id_group, command_text, _id)
+        group_rows = cache.catalog_cache.get(self.cache_namespace, cache_key)
+        if group_rows is not None:
+            return group_rows
 
-    def get(self, id_group: int = 0, command_text: str = "", _id: int = 0) -> list[schemas.GroupRowSchema]:
+        query = select(*self.columns.values())
         if id_group:
-            group_rows = self.db_session.query(models.GroupRowModel).\
-                filter(models.GroupRowModel.id_group == id_group).\
-                all()
+            query = query.where(models.GroupRowModel.id_group == id_group)
         elif command_text:
-            group_rows = self.db_session.query(models.GroupRowModel).\
-                filter(models.GroupRowModel.command_text == command_text).\
-                all()
+            query = query.where(models.GroupRowModel.command_text == command_text)
         elif _id:
-            group_rows = self.db_session.query(models.GroupRowModel).\
-                filter(models.GroupRowModel.id == _id).\
-                all()
+            query = query.where(models.GroupRowModel.id == _id)
         else:
-            group_rows = self.db_session.query(models.GroupRowModel).\
-                order_by(models.GroupRowModel.id).\
-                all()
-
-        if group_rows is not None:
-            return [schemas.GroupRowSchema(id=group_row.id,
-                                           id_group=group_row.id_group,
-                                           name=group_row.name,
-                                           command_text=group_row.command_text,
-                                           file_name=group_row.file_name,
-                                           )
-                    for group_row in group_rows]
-
-    def delete(self, id_group: int = 0, _id: int = 0) -> schemas.GroupRowSchema | None:
+            query = query.order_by(models.GroupRowModel.id)
+        group_rows = [schemas.GroupRowSchema(**group_row._asdict())
+                      for group_row in (await self.db_session.execute(query))]
+        if reads_primary(self.db_session):
+            cache.catalog_cache.set(self.cache_namespace, cache_key, group_rows)
+        return group_rows
+
+    async def delete(self, id_group: int = 0, _id: int = 0) -> schemas.GroupRowSchema | None:
         if id_group:
             query = delete(models.GroupRowModel). \
                 where(models.GroupRowModel.id_group == id_group). \
@@ -280,9 +438,14 @@ class GroupRowController:
                 where(models.GroupRowModel.id == _id). \
                 returning(models.GroupRowModel)
 
-        deleted_group_row_rec = self.db_session.execute(query).fetchone()
-        self.db_session.commit()
-        if deleted_group_row_rec is not None:
+        deleted_group_rows = (await self.db_session.scalars(query)).all()
+        await self.db_session.commit()
+        cache.catalog_cache.invalidate(self.cache_namespace)
+        cache.catalog_cache.invalidate(GroupController.tree_cache_namespace)
+        for deleted_group_row_rec in deleted_group_rows:
+            commands.command_router.remove(deleted_group_row_rec.id)
+        if deleted_group_rows:
+            deleted_group_row_rec = deleted_group_rows[0]
             return schemas.GroupRowSchema(id=deleted_group_row_rec.id,
                                           id_group=deleted_group_row_rec.id_group,
                                           name=deleted_group_row_rec.name,
@@ -290,65 +453,105 @@ class GroupRowController:
                                           file_name=deleted_group_row_rec.file_name,
                                           )
 
-    def update(self, _id: int, **kwargs) -> schemas.GroupRowSchema | None:
+    async def update(self, _id: int, **kwargs) -> schemas.GroupRowSchema | None:
         query = update(models.GroupRowModel). \
             where(models.GroupRowModel.id == _id). \
             values(kwargs). \
             returning(models.GroupRowModel)
-        update_group_row_rec = self.db_session.execute(query).fetchone()
-        self.db_session.commit()
+        update_group_row_rec = (await self.db_session.scalars(query)).first()
+        await self.db_session.commit()
+        cache.catalog_cache.invalidate(self.cache_namespace)
+        cache.catalog_cache.invalidate(GroupController.tree_cache_namespace)
         if update_group_row_rec is not None:
-            return schemas.GroupRowSchema(id=update_group_row_rec[0].id,
-                                          id_group=update_group_row_rec[0].id_group,
-                                          name=update_group_row_rec[0].name,
-                                          command_text=update_group_row_rec[0].command_text,
-                                          file_name=update_group_row_rec[0].file_name,
-                                          )
+            updated_group_row = schemas.GroupRowSchema(id=update_group_row_rec.id,
+                                                       id_group=update_group_row_rec.id_group,
+                                                       name=update_group_row_rec.name,
+                                                       command_text=update_group_row_rec.command_text,
+                                                       file_name=update_group_row_rec.file_name,
+                                                       )
+            commands.command_router.put(updated_group_row)
+            return updated_group_row
+
+
+    async def create_many(self, group_rows: list[schemas.GroupRowSchemaCreate]) -> list[schemas.BulkItemResultSchema]:
+        """Insert group rows in one transaction, rows of missing groups are skipped and reported"""
+        existing_groups = await _existing_ids(self.db_session, models.GroupModel.id,
+                                              [group_row.id_group for group_row in group_rows])
+        valid_rows = [group_row for group_row in group_rows if group_row.id_group in existing_groups]
+        new_ids = iter([])
+        if valid_rows:
+            query = insert(models.GroupRowModel).\
+                returning(models.GroupRowModel.id, sort_by_parameter_order=True)
+            inserted_ids = (await self.db_session.scalars(query, [group_row.model_dump()
+                                                                   for group_row in valid_rows])).all()
+            await self.db_session.commit()
+            cache.catalog_cache.invalidate(self.cache_namespace)
+            cache.catalog_cache.invalidate(GroupController.tree_cache_namespace)
+            for new_id, group_row in zip(inserted_ids, valid_rows):
+                commands.command_router.put(schemas.GroupRowSchema(id=new_id, **group_row.model_dump()))
+            new_ids = iter(inserted_ids)
+        return [schemas.BulkItemResultSchema(index=index, ok=True, id=next(new_ids))
+                if group_row.id_group in existing_groups else
+                schemas.BulkItemResultSchema(index=index, ok=False,
+                                             detail=f"Group with id {group_row.id_group} not found.")
+                for index, group_row in enumerate(group_rows)]
 
 
 class TaskController:
     """Data Access Layer and business logic for operating tasks"""
+    # Columns of the read queries by the schema field name
+    columns = {
+        "id": models.TaskModel.id,
+        "id_employee": models.TaskModel.id_employee,
+        "last_context": models.TaskModel.last_context,
+        "message_text": models.TaskModel.message_text,
+    }
+
     def __init__(self, db_session):
         self.db_session = db_session
 
-    def create(self, task: schemas.TaskSchemaCreate) -> schemas.TaskSchema:
+    async def stream(self, id_employee: int, after_id: int = 0) -> AsyncIterator[dict]:
+        query = select(*self.columns.values()).\
+            where(models.TaskModel.id_employee == id_employee, models.TaskModel.id > after_id).\
+            order_by(models.TaskModel.id)
+        async for row in pagination.stream_rows(self.db_session, query):
+            yield row
+
+    async def create(self, task: schemas.TaskSchemaCreate) -> schemas.TaskSchema:
         new_task = models.TaskModel(
             id_employee=task.id_employee,
             last_context=task.last_context,
             message_text=task.message_text,
         )
         self.db_session.add(new_task)
-        self.db_session.commit()
-        self.db_session.refresh(new_task)
-        return schemas.TaskSchema(id=new_task.id,
-                                  id_employee=new_task.id_employee,
-                                  last_context=new_task.last_context,
-                                  message_text=new_task.message_text,
-                                  )
-
-    def get(self, id_employee: int = 0, _id: int = 0) -> list[schemas.TaskSchema]:
+        await self.db_session.commit()
+        await self.db_session.refresh(new_task)
+        created_task = schemas.TaskSchema(id=new_task.id,
+                                          id_employee=new_task.id_employee,
+                                          last_context=new_task.last_context,
+                                          message_text=new_task.message_text,
+                                          )
+        inbox.task_inbox.publish([created_task])
+        return created_task
+
+    async def get(self, id_employee: int = 0, _id: int = 0,
+                  limit: int = 0, offset: int = 0, after_id: int = 0) -> list[schemas.TaskSchema]:
+        """Tasks ordered by id, after_id is the keyset cursor: only tasks with a greater id are returned"""
+        query = select(*self.columns.values())
         if id_employee:
-            tasks = self.db_session.query(models.TaskModel).\
-                filter(models.TaskModel.id_employee == id_employee).\
-                all()
+            query = query.where(models.TaskModel.id_employee == id_employee)
         elif _id:
-            tasks = self.db_session.query(models.TaskModel).\
-                filter(models.TaskModel.id == _id).\
-                all()
-        else:
-            tasks = self.db_session.query(models.TaskModel).\
-                order_by(models.TaskModel.id).\
-                all()
-
-        if tasks is not None:
-            return [schemas.TaskSchema(id=task.id,
-                                       id_employee=task.id_employee,
-                                       last_context=task.last_context,
-                                       message_text=task.message_text,
-                                       )
-                    for task in tasks]
-
-    def delete(self, id_employee: int = 0, _id: int = 0) -> schemas.TaskSchema | None:
+            query = query.where(models.TaskModel.id == _id)
+        query = query.order_by(models.TaskModel.id)
+        if after_id:
+            query = query.where(models.TaskModel.id > after_id)
+        if offset:
+            query = query.offset(offset)
+        if limit:
+            query = query.limit(limit)
+        return [schemas.TaskSchema(**task._asdict()) for task in (await self.db_session.execute(query))]
+
+    async def delete(self, id_employee: int = 0, _id: int = 0) -> schemas.TaskSchema | None:
         if id_employee:
             query = delete(models.TaskModel). \
                 where(models.TaskModel.id_employee == id_employee). \
@@ -358,8 +561,8 @@ class TaskController:
                 where(models.TaskModel.id == _id). \
                 returning(models.TaskModel)
 
-        deleted_task_rec = self.db_session.execute(query).fetchone()
-        self.db_session.commit()
+        deleted_task_rec = (await self.db_session.scalars(query)).first()
+        await self.db_session.commit()
         if deleted_task_rec is not None:
             return schemas.TaskSchema(id=deleted_task_rec.id,
                                       id_employee=deleted_task_rec.id_employee,
@@ -367,16 +570,109 @@ class TaskController:
                                       message_text=deleted_task_rec.message_text,
                                       )
 
-    def update(self, _id: int, **kwargs) -> schemas.TaskSchema | None:
+    async def update(self, _id: int, **kwargs) -> schemas.TaskSchema | None:
         query = update(models.TaskModel). \
             where(models.TaskModel.id == _id). \
             values(kwargs). \
             returning(models.TaskModel)
-        update_task_rec = self.db_session.execute(query).fetchone()
-        self.db_session.commit()
+        update_task_rec = (await self.db_session.scalars(query)).first()
+        await self.db_session.commit()
         if update_task_rec is not None:
-            return schemas.TaskSchema(id=update_task_rec[0].id,
-                                      id_employee=update_task_rec[0].id_employee,
-                                      last_context=update_task_rec[0].last_context,
-                                      message_text=update_task_rec[0].message_text,
+            return schemas.TaskSchema(id=update_task_rec.id,
+                                      id_employee=update_task_rec.id_employee,
+                                      last_context=update_task_rec.last_context,
+                                      message_text=update_task_rec.message_text,
                                       )
+
+    async def create_many(self, tasks: list[schemas.TaskSchemaCreate]) -> list[schemas.BulkItemResultSchema]:
+        """Insert tasks in one transaction"""
+        query = insert(models.TaskModel).\
+            returning(models.TaskModel.id, sort_by_parameter_order=True)
+        new_ids = (await self.db_session.scalars(query, [task.model_dump() for task in tasks])).all()
+        await self.db_session.commit()
+        inbox.task_inbox.publish([schemas.TaskSchema(id=new_id, **task.model_dump())
+                                  for new_id, task in zip(new_ids, tasks)])
+        return [schemas.BulkItemResultSchema(index=index, ok=True, id=new_id)
+                for index, new_id in enumerate(new_ids)]
+
+    async def delete_many(self, ids: list[int]) -> list[schemas.BulkItemResultSchema]:
+        """Delete tasks by id in one transaction, missing tasks are reported as not found"""
+        deleted = set()
+        for chunk in _chunks(list(set(ids))):
+            query = delete(models.TaskModel).\
+                where(models.TaskModel.id.in_(chunk)).\
+                returning(models.TaskModel.id)
+            deleted.update((await self.db_session.scalars(query)).all())
+        await self.db_session.commit()
+        return [schemas.BulkItemResultSchema(index=index,
+                                             ok=_id in deleted,
+                                             id=_id,
+                                             detail=None if _id in deleted else f"Task with _id {_id} not found.",
+                                             )
+                for index, _id in enumerate(ids)]
+
+    async def claim(self, id_employee: int, batch: int, visibility_seconds: int) -> schemas.TaskClaimSchema:
+        """Claim up to batch oldest tasks of the employee in one UPDATE ... OUTPUT statement.
+
+        Tasks are hidden from other workers for visibility_seconds, then claimed again unless acknowledged.
+        On SQL Server the rows locked by a concurrent claim are skipped (READPAST), so workers get different tasks.
+        """
+        now = datetime.utcnow()
+        claim_token = secrets.token_hex(16)
+        claimed_until = now + timedelta(seconds=visibility_seconds)
+        claimable = select(models.TaskModel.id).\
+            with_hint(models.TaskModel, "WITH (UPDLOCK, READPAST, ROWLOCK)", "mssql").\
+            where(models.TaskModel.id_employee == id_employee,
+                  or_(models.TaskModel.claimed_until.is_(None), models.TaskModel.claimed_until < now)).\
+            order_by(models.TaskModel.id).\
+            limit(batch)
+        query = update(models.TaskModel).\
+            where(models.TaskModel.id.in_(claimable)).\
+            values(claimed_until=claimed_until, claim_token=claim_token).\
+            returning(*self.columns.values()).\
+            execution_options(synchronize_session=False)
+        tasks = (await self.db_session.execute(query)).all()
+        await self.db_session.commit()
+        # Order of the OUTPUT rows is not defined
+        return schemas.TaskClaimSchema(claim_token=claim_token,
+                                       claimed_until=claimed_until,
+                                       tasks=sorted((schemas.TaskSchema(**task._asdict()) for task in tasks),
+                                                    key=lambda task: task.id),
+                                       )
+
+    async def ack(self, claim_token: str, ids: list[int]) -> list[schemas.BulkItemResultSchema]:
+        """Delete the processed tasks. Tasks claimed again by another worker after the visibility timeout
+        are not deleted and reported as failed"""
+        acked = set()
+        for chunk in _chunks(list(set(ids))):
+            query = delete(models.TaskModel).\
+                where(models.TaskModel.id.in_(chunk), models.TaskModel.claim_token == claim_token).\
+                returning(models.TaskModel.id)
+            acked.update((await self.db_session.scalars(query)).all())
+        await self.db_session.commit()
+        return self._claim_results(ids, acked)
+
+    async def nack(self, claim_token: str, ids: list[int],
+                   delay_seconds: int = 0) -> list[schemas.BulkItemResultSchema]:
+        """Return the tasks to the queue at once or after delay_seconds"""
+        claimed_until = datetime.utcnow() + timedelta(seconds=delay_seconds) if delay_seconds else None
+        released = set()
+        for chunk in _chunks(list(set(ids))):
+            query = update(models.TaskModel).\
+                where(models.TaskModel.id.in_(chunk), models.TaskModel.claim_token == claim_token).\
+                values(claimed_until=claimed_until, claim_token=None).\
+                returning(models.TaskModel.id).\
+                execution_options(synchronize_session=False)
+            released.update((await self.db_session.scalars(query)).all())
+        await self.db_session.commit()
+        return self._claim_results(ids, released)
+
+    @staticmethod
+    def _claim_results(ids: list[int], done: set[int]) -> list[schemas.BulkItemResultSchema]:
+        return [schemas.BulkItemResultSchema(index=index,
+                                             ok=_id in done,
+                                             id=_id,
+                                             detail=None if _id in done else f"Task with _id {_id} is not claimed "
+                                                                             f"with this token.",
+                                             )
+                for index, _id in enumerate(ids)]
@@ -1,16 +1,199 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+import logging
+import random
+import time
+from functools import partial
+
+from sqlalchemy import MetaData, Select, event, inspect
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError, InvalidRequestError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine, async_sessionmaker
+from sqlalchemy.orm import Session, declarative_base
+
+import metrics
+import profiling
+from config import Config
+
+slow_query_logger = logging.getLogger("support.slow_queries")
+schema_logger = logging.getLogger("support.schema")
+
+
+def _instrument_queries(engine: AsyncEngine):
+    """Count the statements and the pool checkout wait of the current request in metrics, record the statements
+    of the profiled request and log a sample of the statements running longer than Config.DB_SLOW_QUERY_SECONDS"""
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        metrics.query_started()
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+        metrics.observe_query(elapsed)
+        profiling.record_statement(statement, elapsed)
+        if elapsed >= Config.DB_SLOW_QUERY_SECONDS and random.random() < Config.DB_SLOW_QUERY_SAMPLE_RATE:
+            slow_query_logger.warning("Slow query (%.3f s): %s", elapsed, statement)
+
+    @event.listens_for(engine.sync_engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics.connection_checked_out()
+
+
+@event.listens_for(Session, "do_orm_execute")
+def do_orm_execute(orm_execute_state):
+    # Sessions take their connection from the pool at the first statement
+    metrics.session_execute_started()
+
+
+def make_engine(url: str, pool_size: int) -> AsyncEngine:
+    """Create engine for interaction with database with the pool and logging settings from Config"""
+    options = dict(echo=Config.DB_ECHO,
+                   pool_pre_ping=Config.DB_POOL_PRE_PING,
+                   pool_recycle=Config.DB_POOL_RECYCLE_SECONDS,
+                   )
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend != "sqlite":
+        options.update(pool_size=pool_size,
+                       max_overflow=Config.DB_MAX_OVERFLOW,
+                       pool_timeout=Config.DB_POOL_TIMEOUT_SECONDS,
+                       )
+    engine = create_async_engine(url, **options)
+    _instrument_queries(engine)
+    if url.get_driver_name() == "aioodbc" and Config.DB_FAST_EXECUTEMANY:
+        event.listen(engine.sync_engine, "before_cursor_execute", _set_fast_executemany)
+    return engine
+
+
+def _set_fast_executemany(conn, cursor, statement, parameters, context, executemany):
+    """fast_executemany of pyodbc sends the parameters of executemany (bulk updates) to the server in one round trip.
+    The fast_executemany engine option can't be used with aioodbc: the dialect sets it on the async cursor adapter,
+    which has no such attribute, so it is set on the pyodbc cursor under the adapter"""
+    if executemany:
+        cursor._cursor._impl.fast_executemany = True
+
+
+# Separate pools for the writes and for the read-only requests, so long reads do not hold up writes
+engine = make_engine(Config.DATABASE_URL, Config.DB_POOL_SIZE)
+replica_engines = [make_engine(url, Config.DB_READ_POOL_SIZE) for url in Config.DATABASE_REPLICA_URLS]
+
+
+class ReplicaRouter:
+    """Chooses the replica of the read-only sessions.
+
+    Replicas are taken round robin or by the fewest connections in use, skipping replicas with a recent
+    connection error. The primary is used when no replica is available and for the clients which wrote
+    something within Config.READ_YOUR_WRITES_SECONDS, so they read their own writes.
+    """
+    max_clients = 10000
+
+    def __init__(self, replicas: list[AsyncEngine], strategy: str):
+        self.replicas = replicas
+        self.strategy = strategy
+        self._next = 0
+        self._down_until: dict[int, float] = {}
+        self._sticky_until: dict[str, float] = {}
+        for index, replica in enumerate(replicas):
+            event.listen(replica.sync_engine, "handle_error", partial(self._on_error, index))
+
+    def _on_error(self, index: int, context):
+        if context.is_disconnect or context.connection is None:
+            self._down_until[index] = time.monotonic() + Config.REPLICA_RETRY_SECONDS
+
+    def is_down(self, replica: AsyncEngine) -> bool:
+        now = time.monotonic()
+        return any(self._down_until.get(index, 0) > now for index, item in enumerate(self.replicas) if item is replica)
+
+    def note_write(self, client: str):
+        now = time.monotonic()
+        if len(self._sticky_until) >= self.max_clients:
+            self._sticky_until = {key: until for key, until in self._sticky_until.items() if until > now}
+        self._sticky_until[client] = now + Config.READ_YOUR_WRITES_SECONDS
+
+    def choose(self, client: str) -> AsyncEngine:
+        now = time.monotonic()
+        if self._sticky_until.get(client, 0) > now:
+            return engine
+        available = [replica for index, replica in enumerate(self.replicas) if self._down_until.get(index, 0) <= now]
+        if not available:
+            return engine
+        if self.strategy == "least_busy":
+            return min(available, key=lambda replica: getattr(replica.sync_engine.pool, "checkedout", lambda: 0)())
+        self._next += 1
+        return available[self._next % len(available)]
+
+
+replica_router = ReplicaRouter(replica_engines, Config.REPLICA_STRATEGY)
+
+
+class RoutingSession(Session):
+    """Session of the read-only requests: SELECT statements go to the replica chosen for the session
+    (info["replica"]), everything else - to the primary.
+
+    When the replica can't be connected (the error marks it down in replica_router) the statement is run again
+    on the primary and the rest of the session reads the primary, so the request does not fail.
+    Controllers read columns, not ORM objects, so nothing is tracked and a flush of changed objects is a bug.
+    """
+    def get_bind(self, mapper=None, clause=None, **kw):
+        replica = self.info.get("replica")
+        if replica is not None and isinstance(clause, Select) and not self._flushing:
+            return replica.sync_engine
+        return engine.sync_engine
+
+    def execute(self, statement, *args, **kwargs):
+        return self._with_primary_fallback(super().execute, statement, *args, **kwargs)
+
+    def scalar(self, statement, *args, **kwargs):
+        return self._with_primary_fallback(super().scalar, statement, *args, **kwargs)
+
+    def _with_primary_fallback(self, method, *args, **kwargs):
+        replica = self.info.get("replica")
+        try:
+            return method(*args, **kwargs)
+        except DBAPIError:
+            if replica is None or replica is engine or not replica_router.is_down(replica):
+                raise
+        self.rollback()
+        self.info["replica"] = engine
+        return method(*args, **kwargs)
+
+    def flush(self, objects=None):
+        if self.new or self.dirty or self.deleted:
+            raise InvalidRequestError("Objects can't be written through the read-only session")
+        super().flush(objects)
+
+
+def reads_primary(session) -> bool:
+    """Whether the SELECTs of the session read the primary: the write sessions and the read sessions routed
+    to the primary (read-your-writes, no replica available) or to a replica with the primary URL"""
+    replica = session.info.get("replica")
+    return replica is None or replica.url == engine.url
+
+
+async def check_indexes(metadata: MetaData) -> list[str]:
+    """Warn about the indexes of the models missing in the primary database (migrations are not applied).
+    Indexes are compared by their columns, so the same indexes created under other names are accepted"""
+    def missing_indexes(connection) -> list[str]:
+        inspector = inspect(connection)
+        missing = []
+        for table in metadata.sorted_tables:
+            if not table.indexes or not inspector.has_table(table.name):
+                continue
+            existing = {tuple(index["column_names"]) for index in inspector.get_indexes(table.name)}
+            missing += [index.name for index in table.indexes
+                        if tuple(column.name for column in index.columns) not in existing]
+        return missing
+
+    async with engine.connect() as connection:
+        missing = await connection.run_sync(missing_indexes)
+    for name in missing:
+        schema_logger.warning("Index %s is missing in the database, apply the migrations: alembic upgrade head", name)
+    return missing
 
-# DATABASE CONFIG
-DB_DRIVER = "ODBC Driver 11 for SQL Server"
-DB_HOST = "DESKTOP-255RLKB\SQLEXPRESS"
-DB_DATABASE = "support"
-SQLALCHEMY_DATABASE_URL = f"mssql+pyodbc://@{DB_HOST}/{DB_DATABASE}?&driver={DB_DRIVER}"
 
-# create engine for interaction with database
-engine = create_engine(SQLALCHEMY_DATABASE_URL, echo=True)
 # json_serializer=lambda x: x
-# create session for the interaction with database
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# create async session for the interaction with database,
+# objects are not expired on commit because lazy loading is not available in async mode
+SessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False, bind=engine)
+ReadSessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False, sync_session_class=RoutingSession)
 #
 Base = declarative_base()
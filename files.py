@@ -0,0 +1,153 @@
+import mimetypes
+import os
+import pathlib
+import re
+from collections import OrderedDict
+from typing import AsyncIterator
+from urllib.parse import quote
+
+import anyio
+from fastapi import HTTPException, Request, Response, status
+from fastapi.responses import FileResponse, StreamingResponse
+
+from config import Config
+
+FILE_CHUNK_SIZE = 64 * 1024
+_range_re = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+class FileCache:
+    """LRU cache of the contents of small files, bounded by the total size.
+
+    Entries are keyed by the path and the ETag, so a changed file is read again.
+    """
+    def __init__(self, max_bytes: int, max_file_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple[pathlib.Path, str], bytes] = OrderedDict()
+
+    def get(self, path: pathlib.Path, etag: str) -> bytes | None:
+        content = self._entries.get((path, etag))
+        if content is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end((path, etag))
+        self.hits += 1
+        return content
+
+    def set(self, path: pathlib.Path, etag: str, content: bytes):
+        for key in [key for key in self._entries if key[0] == path]:
+            self.size -= len(self._entries.pop(key))
+        self._entries[(path, etag)] = content
+        self.size += len(content)
+        while self.size > self.max_bytes:
+            self.size -= len(self._entries.popitem(last=False)[1])
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "files": len(self._entries), "bytes": self.size}
+
+
+file_cache = FileCache(max_bytes=Config.FILES_CACHE_MAX_BYTES, max_file_bytes=Config.FILES_CACHE_MAX_FILE_BYTES)
+
+
+def storage_path(file_name: str) -> pathlib.Path | None:
+    """Absolute path of the file in Config.FILES_ROOT, None when the name leads outside the root"""
+    root = Config.FILES_ROOT.resolve()
+    path = (root / file_name).resolve()
+    return path if path.is_relative_to(root) else None
+
+
+def resolve(file_name: str) -> pathlib.Path:
+    """Path of the existing file in Config.FILES_ROOT, names leading outside the root are treated as missing files"""
+    path = storage_path(file_name)
+    if path is None or not path.is_file():
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"File {file_name} not found.")
+    return path
+
+
+def file_etag(stat_result: os.stat_result) -> str:
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """First and last byte of the single range of the Range header.
+
+    Returns None when the whole file should be sent: no or malformed header, several ranges.
+    Raises 416 error when the range is outside the file.
+    """
+    match = _range_re.fullmatch(header.strip())
+    if match is None or match.group(1) == match.group(2) == "":
+        return None
+    start, end = match.groups()
+    if start == "":
+        # Suffix range: the last bytes of the file
+        first, last = max(size - int(end), 0), size - 1
+    else:
+        first, last = int(start), min(int(end), size - 1) if end else size - 1
+    if first > last or first >= size:
+        raise HTTPException(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                            detail=f"Range {header} not satisfiable",
+                            headers={"Content-Range": f"bytes */{size}"})
+    return first, last
+
+
+async def read_chunks(path: pathlib.Path, first: int, last: int) -> AsyncIterator[bytes]:
+    async with await anyio.open_file(path, mode="rb") as file:
+        await file.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            chunk = await file.read(min(FILE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+async def file_response(request: Request, file_name: str) -> Response:
+    """Response with the file or its byte range.
+
+    304 is returned when If-None-Match has the ETag of the file. Files up to Config.FILES_CACHE_MAX_FILE_BYTES
+    are served from memory, bigger files are streamed from disk.
+    """
+    path = resolve(file_name)
+    stat_result = path.stat()
+    size = stat_result.st_size
+    etag = file_etag(stat_result)
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f"attachment; filename*=utf-8''{quote(path.name)}",
+    }
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+    byte_range = None
+    if_range = request.headers.get("if-range")
+    if "range" in request.headers and (if_range is None or if_range.strip() == etag):
+        byte_range = parse_range(request.headers["range"], size)
+    media_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+
+    if size <= file_cache.max_file_bytes:
+        content = file_cache.get(path, etag)
+        if content is None:
+            content = await anyio.Path(path).read_bytes()
+            file_cache.set(path, etag, content)
+        if byte_range is None:
+            return Response(content=content, media_type=media_type, headers=headers)
+        first, last = byte_range
+        headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+        return Response(content=content[first:last + 1], status_code=status.HTTP_206_PARTIAL_CONTENT,
+                        media_type=media_type, headers=headers)
+
+    if byte_range is None:
+        return FileResponse(path, media_type=media_type, headers=headers, stat_result=stat_result)
+    first, last = byte_range
+    headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+    headers["Content-Length"] = str(last - first + 1)
+    return StreamingResponse(read_chunks(path, first, last), status_code=status.HTTP_206_PARTIAL_CONTENT,
+                             media_type=media_type, headers=headers)
@@ -0,0 +1,101 @@
+import asyncio
+from collections import deque
+from contextlib import contextmanager
+from typing import Iterator
+
+import schemas
+from config import Config
+
+
+class Subscription:
+    """New tasks of one employee for one listener.
+
+    Tasks are collected until the listener takes them. When more than max_size tasks are waiting
+    they are dropped and the subscription is marked as overflowed: the listener should read the missed
+    tasks from the database.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.pending: list[schemas.TaskSchema] = []
+        self.overflowed = False
+        self._published = asyncio.Event()
+
+    def put(self, task: schemas.TaskSchema):
+        if len(self.pending) >= self.max_size:
+            self.pending.clear()
+            self.overflowed = True
+        elif not self.overflowed:
+            self.pending.append(task)
+        self._published.set()
+
+    async def wait(self, timeout: float) -> bool:
+        """Wait for new tasks, False when none were published within timeout seconds"""
+        try:
+            await asyncio.wait_for(self._published.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def take(self) -> tuple[list[schemas.TaskSchema], bool]:
+        """Collected tasks and whether some tasks were dropped"""
+        tasks, overflowed = self.pending, self.overflowed
+        self.pending, self.overflowed = [], False
+        self._published.clear()
+        return tasks, overflowed
+
+
+class SentTasks:
+    """Ids of the tasks sent to a listener, to send every task once.
+
+    Ids are given at INSERT but tasks are published after COMMIT, so a task may be published after a task
+    with a higher id: the ids are kept as a set of the last max_size sent tasks, not as the highest id sent.
+    Re-reads of the database start after after_id, the highest of the ids dropped from the set.
+    """
+    def __init__(self, after_id: int, max_size: int):
+        self.after_id = after_id
+        self.max_size = max_size
+        self._order: deque[int] = deque()
+        self._ids: set[int] = set()
+
+    def add(self, task_id: int) -> bool:
+        """Remember the task, False when it was already sent"""
+        if task_id <= self.after_id or task_id in self._ids:
+            return False
+        self._order.append(task_id)
+        self._ids.add(task_id)
+        if len(self._order) > self.max_size:
+            dropped = self._order.popleft()
+            self._ids.discard(dropped)
+            self.after_id = max(self.after_id, dropped)
+        return True
+
+
+class TaskInbox:
+    """In-process fan-out of the created tasks to the listeners of their employees.
+
+    Only the tasks created through this server process are published, listeners read the database
+    from time to time to pick up the tasks created by other processes.
+    """
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self._subscribers: dict[int, set[Subscription]] = {}
+
+    @contextmanager
+    def subscribe(self, id_employee: int) -> Iterator[Subscription]:
+        subscription = Subscription(self.queue_size)
+        self._subscribers.setdefault(id_employee, set()).add(subscription)
+        try:
+            yield subscription
+        finally:
+            subscribers = self._subscribers[id_employee]
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[id_employee]
+
+    def publish(self, tasks: list[schemas.TaskSchema]):
+        for task in tasks:
+            for subscription in self._subscribers.get(task.id_employee, ()):
+                subscription.put(task)
+
+
+task_inbox = TaskInbox(queue_size=Config.TASK_STREAM_QUEUE_SIZE)
@@ -0,0 +1,119 @@
+import asyncio
+import importlib
+import json
+import multiprocessing
+import os
+import pathlib
+import tempfile
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+import schemas
+from config import Config
+
+
+def generate_report(generator: str, path: str, params: dict) -> int:
+    """Runs in a worker process: the generator writes a temporary file next to the path, which then
+    replaces the report file at once, so readers never see a half-written report. Returns the file size"""
+    module_name, _, function_name = generator.rpartition(".")
+    function = getattr(importlib.import_module(module_name), function_name)
+    target = pathlib.Path(path)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=target.parent, prefix=f".{target.name}.", suffix=".tmp")
+    os.close(fd)
+    try:
+        function(temp_path, **params)
+        os.replace(temp_path, target)
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+    return target.stat().st_size
+
+
+class JobQueue:
+    """Report generation jobs run by a pool of worker processes.
+
+    At most concurrency jobs of one report run at once, the others wait in the queue. A job for the report
+    and params which are already queued or running is not created, the existing job is returned instead.
+    Jobs are kept in memory of the server process, so GET /jobs/{id} should reach the process which created the job.
+    """
+    def __init__(self, workers: int, concurrency: int, max_kept: int):
+        self.workers = workers
+        self.concurrency = concurrency
+        self.max_kept = max_kept
+        self.jobs: OrderedDict[str, schemas.JobSchema] = OrderedDict()
+        self._in_flight: dict[tuple[str, str], schemas.JobSchema] = {}
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._executor: ProcessPoolExecutor | None = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        # Workers are spawned, not forked, so they don't inherit the event loop and the database connections
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def get(self, job_id: str) -> schemas.JobSchema | None:
+        return self.jobs.get(job_id)
+
+    def submit(self, code_name: str, generator: str, file_name: str, path: pathlib.Path,
+               params: dict) -> schemas.JobSchema:
+        key = (code_name, json.dumps(params, sort_keys=True))
+        job = self._in_flight.get(key)
+        if job is not None:
+            return job
+
+        job = schemas.JobSchema(id=uuid.uuid4().hex,
+                                code_name=code_name,
+                                file_name=file_name,
+                                params=params,
+                                created_at=datetime.utcnow(),
+                                )
+        self._in_flight[key] = job
+        self.jobs[job.id] = job
+        self._forget_finished()
+        task = asyncio.create_task(self._run(job, key, generator, str(path)))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    async def _run(self, job: schemas.JobSchema, key: tuple[str, str], generator: str, path: str):
+        semaphore = self._semaphores.setdefault(job.code_name, asyncio.Semaphore(self.concurrency))
+        try:
+            async with semaphore:
+                job.status = schemas.JobStatusSchema.running
+                job.started_at = datetime.utcnow()
+                loop = asyncio.get_running_loop()
+                job.size = await loop.run_in_executor(self.executor, generate_report, generator, path, job.params)
+                job.status = schemas.JobStatusSchema.done
+        except Exception as err:
+            if isinstance(err, BrokenProcessPool):
+                # A worker died (killed, out of memory), the next job starts a new pool
+                self._executor = None
+            job.status = schemas.JobStatusSchema.failed
+            job.error = f"{type(err).__name__}: {err}"
+        finally:
+            job.finished_at = datetime.utcnow()
+            self._in_flight.pop(key, None)
+
+    def _forget_finished(self):
+        """Drop the oldest finished jobs over max_kept"""
+        finished = [job_id for job_id, job in self.jobs.items()
+                    if job.status in (schemas.JobStatusSchema.done, schemas.JobStatusSchema.failed)]
+        for job_id in finished[:max(len(self.jobs) - self.max_kept, 0)]:
+            del self.jobs[job_id]
+
+    def shutdown(self):
+        for task in self._tasks:
+            task.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+report_jobs = JobQueue(workers=Config.REPORT_WORKERS,
+                       concurrency=Config.REPORT_CONCURRENCY_PER_REPORT,
+                       max_kept=Config.REPORT_JOBS_MAX_KEPT)
@@ -1,29 +1,48 @@
+import asyncio
+import hashlib
+import logging
 import uvicorn
 from contextlib import asynccontextmanager
-from typing import Annotated, Generator
-from fastapi import FastAPI, Depends, HTTPException, status
+from typing import Annotated, AsyncGenerator, AsyncIterator, Callable, Literal
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response, WebSocket, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi import APIRouter
-from fastapi.responses import HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from datetime import datetime
 from pyodbc import OperationalError
-from sqlalchemy.orm import Session
+from pydantic_core import to_json
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import schemas
 import auth
+import cache
+import commands
 import controllers
-from database import SessionLocal, engine, Base
+import files
+import inbox
+import jobs
+import metrics
+import models
+import pagination
+import profiling
+from config import Config
+from database import SessionLocal, ReadSessionLocal, check_indexes, engine, replica_engines, replica_router, Base
 
 db = None
+stream_logger = logging.getLogger("support.tasks_stream")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     global db
     try:
-        # TODO: Check connection DB
-        pass
+        # Check connection DB, fill the users directory and the bot command router
+        async with SessionLocal() as session_db:
+            await auth.update_list_users(session_db)
+            await commands.update_command_router(session_db)
+        await check_indexes(models.Base.metadata)
     except OperationalError as err:
         print("Database connection error: \n", err)
         raise
@@ -31,6 +50,11 @@ async def lifespan(app: FastAPI):
         print(f"Unexpected {err=}, {type(err)=}")
         raise
     yield
+    auth.password_executor.shutdown(wait=False)
+    jobs.report_jobs.shutdown()
+    await engine.dispose()
+    for replica in replica_engines:
+        await replica.dispose()
     if db is not None:
         pass
 
@@ -52,19 +76,69 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[pagination.NEXT_CURSOR_HEADER, "ETag", "Content-Range", "Content-Disposition"],
 )
 
+# Costs one check per request until an admin enables the profiling
+app.add_middleware(profiling.ProfilingMiddleware)
+
+# Added last, so it is the outer middleware and measures the whole request
+if Config.METRICS_ENABLED:
+    app.add_middleware(metrics.MetricsMiddleware)
+
 # Create an object to work with HTTP authorization headers
 oauth2_schema = OAuth2PasswordBearer(tokenUrl="login")
 
 
 # Dependency
-async def get_db() -> Generator:
-    _db = SessionLocal()
-    try:
+def client_key(request: Request) -> str:
+    """Client identity for the read-your-writes routing: its token, or its address for anonymous requests"""
+    authorization = request.headers.get("authorization")
+    if authorization:
+        return hashlib.sha256(authorization.encode()).hexdigest()
+    return request.client.host if request.client else ""
+
+
+async def get_db(request: Request) -> AsyncGenerator[AsyncSession, None]:
+    if request.method != "GET":
+        replica_router.note_write(client_key(request))
+    async with SessionLocal() as _db:
+        yield _db
+
+
+async def get_read_db(request: Request) -> AsyncGenerator[AsyncSession, None]:
+    """Session of the read-only routes, its queries go to a replica"""
+    async with ReadSessionLocal(info={"replica": replica_router.choose(client_key(request))}) as _db:
         yield _db
-    finally:
-        _db.close()
+
+
+def ndjson_response(request: Request,
+                    stream_rows: Callable[[AsyncSession], AsyncIterator[dict]]) -> StreamingResponse:
+    """Stream rows as newline delimited JSON while they are read from database.
+    The session is opened here because get_read_db is closed before the response body is sent"""
+    replica = replica_router.choose(client_key(request))
+
+    async def lines():
+        async with ReadSessionLocal(info={"replica": replica}) as session_db:
+            async for row in stream_rows(session_db):
+                yield to_json(row) + b"\n"
+    return StreamingResponse(lines(), media_type=pagination.NDJSON_MEDIA_TYPE)
+
+
+def check_bulk_size(items: list):
+    if not items or len(items) > Config.BULK_MAX_ITEMS:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"From 1 to {Config.BULK_MAX_ITEMS} items should be provided")
+
+
+def not_modified(request: Request, response: Response, namespace: str) -> Response | None:
+    """Set ETag of the catalogue response. Returns 304 response (without touching database)
+    when the client already has this version"""
+    etag = cache.etag(namespace, f"{request.url.path}?{request.url.query}")
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    response.headers["ETag"] = etag
 
 
 main_api_router = APIRouter()
@@ -113,23 +187,39 @@ async def get_testdata():
 
 @app.get("/adminsonly", response_model=list[schemas.UserSchema])
 async def get_admins(current_user: Annotated[schemas.UserSchema, Depends(auth.check_admin_user)],
-                     session_db: Annotated[Session, Depends(get_db)],
+                     session_db: Annotated[AsyncSession, Depends(get_db)],
                      ):
-    await auth.update_list_users(session_db)
-    return [user for user in auth.local_users if user.role.value == "admin"]
+    await auth.update_list_users(session_db, force=False)
+    return auth.users_directory.with_role("admin")
+
+
+@app.get("/cache/stats")
+async def get_cache_stats(current_user: Annotated[schemas.UserSchema, Depends(auth.check_admin_user)]):
+    """Hits and misses of the catalogues cache by table and of the files cache"""
+    return {**cache.catalog_cache.stats(), "files": files.file_cache.stats()}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Metrics of this server process in the Prometheus text format, open for the scraper like /"""
+    if not Config.METRICS_ENABLED:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Metrics are disabled")
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
 
 
 @main_api_router.post("/login", response_model=schemas.TokenSchema)
 async def login_user_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-                                      session_db: Annotated[Session, Depends(get_db)]):
+                                      session_db: Annotated[AsyncSession, Depends(get_db)]):
     try:
-        await auth.update_list_users(session_db)
+        await auth.update_list_users(session_db, force=False)
         user = await auth.authenticate_user(form_data.username, form_data.password)
         if not user:
             raise auth.credentials_exception
         token = schemas.TokenSchema(sub=user.user_name)
         access_token = await auth.create_access_token(token=token)
     except Exception as e:
+        if e is auth.password_busy_exception:
+            raise
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="failed to login - " + str(e),
@@ -139,11 +229,13 @@ async def login_user_for_access_token(form_data: Annotated[OAuth2PasswordRequest
 
 
 @main_api_router.post("/registration", response_model=schemas.UserSchema)
-async def registration_new_user(body: schemas.UserSchemaCreate, session_db: Annotated[Session, Depends(get_db)]):
+async def registration_new_user(body: schemas.UserSchemaCreate, session_db: Annotated[AsyncSession, Depends(get_db)]):
     try:
         _user = controllers.UserController(session_db)
-        user = _user.create(body)
+        user = await _user.create(body)
     except Exception as e:
+        if e is auth.password_busy_exception:
+            raise
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
             detail="failed to create user - " + str(e),
@@ -158,52 +250,59 @@ users_router = APIRouter()
 
 @users_router.get("/", response_model=list[schemas.UserSchema])
 async def get_users(current_user: Annotated[schemas.UserSchema, Depends(auth.check_admin_user)],
-                    session_db: Annotated[Session, Depends(get_db)],
+                    session_db: Annotated[AsyncSession, Depends(get_read_db)],
+                    page: Annotated[pagination.PageParams, Depends()],
+                    request: Request,
+                    response: Response,
+                    role: schemas.RoleSchema | None = None,
+                    disabled: bool | None = None,
                     ):
-    # TODO: Make handlers for Controllers
+    if pagination.wants_ndjson(request):
+        return ndjson_response(request, lambda _db: controllers.UserController(_db).stream(
+            page, role=role, disabled=disabled))
     _user_control = controllers.UserController(session_db)
-    return _user_control.get()
+    _users, next_cursor = await _user_control.get_page(page, role=role, disabled=disabled)
+    return pagination.page_response(_users, next_cursor, page, response, schemas.UserSchema)
 
 
 @users_router.post("/", response_model=schemas.UserSchema)
 async def add_user(body: schemas.UserSchemaCreate,
                    current_user: Annotated[schemas.UserSchema, Depends(auth.check_admin_user)],
-                   session_db: Annotated[Session, Depends(get_db)],
+                   session_db: Annotated[AsyncSession, Depends(get_db)],
                    ):
     _user_control = controllers.UserController(session_db)
-    return _user_control.create(body)
+    return await _user_control.create(body)
 
 
 @users_router.patch("/", response_model=schemas.UserSchemaUpdate)
 async def update_user(user_name: str,
                       body: schemas.UserSchemaUpdate,
                       current_user: Annotated[schemas.UserSchema, Depends(auth.check_admin_user)],
-                      session_db: Annotated[Session, Depends(get_db)],
+                      session_db: Annotated[AsyncSession, Depends(get_db)],
                       ):
-    updated_user_params = body.model_dump()
+    updated_user_params = body.model_dump(exclude_unset=True, exclude_none=True)
     if updated_user_params == {}:
         raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
                             detail="At least one parameter for user update info should be provided")
     _user_control = controllers.UserController(session_db)
-    _users = _user_control.get(user_name)
-    if _users is None:
+    updated_user_name = await _user_control.update(user_name, **updated_user_params)
+    if updated_user_name is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"User with name {user_name} not found.")
-    updated_user_name = _user_control.update(user_name, **updated_user_params)
     return updated_user_name
 
 
 @users_router.delete("/", response_model=schemas.UserSchema)
 async def delete_user(user_name: str,
                       current_user: Annotated[schemas.UserSchema, Depends(auth.check_admin_user)],
-                      session_db: Annotated[Session, Depends(get_db)],
+                      session_db: Annotated[AsyncSession, Depends(get_db)],
                       ):
     _user_control = controllers.UserController(session_db)
-    _users = _user_control.get(user_name)
-    if _users is None:
+    _user = await _user_control.delete(user_name)
+    if _user is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"User with name {user_name} not found.")
-    return _user_control.delete(user_name)
+    return _user
 
 
 # Reports
@@ -212,64 +311,130 @@ reports_router = APIRouter()
 
 @reports_router.get("/", response_model=list[schemas.ReportSchema])
 async def get_reports(current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
-                      session_db: Annotated[Session, Depends(get_db)],
+                      session_db: Annotated[AsyncSession, Depends(get_read_db)],
+                      page: Annotated[pagination.PageParams, Depends()],
+                      request: Request,
+                      response: Response,
+                      code_name: str | None = None,
                       ):
-    # TODO: Make handlers for Controllers
+    if pagination.wants_ndjson(request):
+        return ndjson_response(request, lambda _db: controllers.ReportController(_db).stream(
+            page, code_name=code_name))
+    if _not_modified := not_modified(request, response, controllers.ReportController.cache_namespace):
+        return _not_modified
     _report_control = controllers.ReportController(session_db)
-    return _report_control.get()
+    _reports, next_cursor = await _report_control.get_page(page, code_name=code_name)
+    return pagination.page_response(_reports, next_cursor, page, response, schemas.ReportSchema)
 
 
 @reports_router.post("/", response_model=schemas.ReportSchema)
 async def add_report(body: schemas.ReportSchemaCreate,
                      current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
-                     session_db: Annotated[Session, Depends(get_db)],
+                     session_db: Annotated[AsyncSession, Depends(get_db)],
                      ):
     _report_control = controllers.ReportController(session_db)
-    return _report_control.create(body)
+    return await _report_control.create(body)
 
 
 @reports_router.get("/{code_name}", response_model=schemas.ReportSchema)
 async def get_report(code_name: str,
                      current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
-                     session_db: Annotated[Session, Depends(get_db)],
+                     session_db: Annotated[AsyncSession, Depends(get_read_db)],
+                     request: Request,
+                     response: Response,
                      ):
+    if _not_modified := not_modified(request, response, controllers.ReportController.cache_namespace):
+        return _not_modified
     _report_control = controllers.ReportController(session_db)
-    _reports = _report_control.get(code_name=code_name)
-    if _reports is None:
+    _reports = await _report_control.get(code_name=code_name)
+    if not _reports:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Report with code_name {code_name} not found.")
-    return _reports
+    return _reports[0]
+
+
+@reports_router.get("/{code_name}/file", response_class=FileResponse)
+async def get_report_file(code_name: str,
+                          current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
+                          session_db: Annotated[AsyncSession, Depends(get_read_db)],
+                          request: Request,
+                          ):
+    """The report file, supports Range and If-None-Match"""
+    _report_control = controllers.ReportController(session_db)
+    _reports = await _report_control.get(code_name=code_name)
+    if not _reports:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Report with code_name {code_name} not found.")
+    return await files.file_response(request, _reports[0].file_name)
+
+
+@reports_router.post("/{code_name}/run", response_model=schemas.JobSchema, status_code=status.HTTP_202_ACCEPTED)
+async def run_report(code_name: str,
+                     current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
+                     session_db: Annotated[AsyncSession, Depends(get_db)],
+                     body: schemas.ReportRunSchema | None = None,
+                     ):
+    """Enqueue generation of the report file, the job already running for the same params is returned if any"""
+    _report_control = controllers.ReportController(session_db)
+    _reports = await _report_control.get(code_name=code_name)
+    if not _reports:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Report with code_name {code_name} not found.")
+    generator = Config.REPORT_GENERATORS.get(code_name)
+    if generator is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Generator of report {code_name} is not configured.")
+    path = files.storage_path(_reports[0].file_name)
+    if path is None:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"File {_reports[0].file_name} is outside the files storage.")
+    params = body.params if body is not None else {}
+    return jobs.report_jobs.submit(code_name, generator, _reports[0].file_name, path, params)
 
 
 @reports_router.patch("/", response_model=schemas.ReportSchema)
 async def update_report(_id: int,
                         body: schemas.ReportSchemaUpdate,
                         current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
-                        session_db: Annotated[Session, Depends(get_db)],
+                        session_db: Annotated[AsyncSession, Depends(get_db)],
                         ):
-    updated_report_params = body.model_dump()
+    updated_report_params = body.model_dump(exclude_unset=True, exclude_none=True)
     if updated_report_params == {}:
         raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
                             detail="At least one parameter for report update info should be provided")
     _report_control = controllers.ReportController(session_db)
-    _reports = _report_control.get(_id=_id)
-    if _reports is None:
+    _report = await _report_control.update(_id, **updated_report_params)
+    if _report is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Report with _id {str(_id)} not found.")
-    return _report_control.update(_id, **updated_report_params)
+    return _report
+
+
+@reports_router.patch("/bulk", response_model=list[schemas.BulkItemResultSchema])
+async def update_reports(body: list[schemas.ReportSchemaBulkUpdate],
+                         current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
+                         session_db: Annotated[AsyncSession, Depends(get_db)],
+                         ):
+    check_bulk_size(body)
+    _report_control = controllers.ReportController(session_db)
+    try:
+        return await _report_control.update_many(body)
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="failed to update reports - " + str(e))
 
 
 @reports_router.delete("/", response_model=schemas.ReportSchema)
 async def delete_report(_id: int,
                         current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
-                        session_db: Annotated[Session, Depends(get_db)],
+                        session_db: Annotated[AsyncSession, Depends(get_db)],
                         ):
     _report_control = controllers.ReportController(session_db)
-    _reports = _report_control.get(_id=_id)
-    if _reports is None:
+    _report = await _report_control.delete(_id=_id)
+    if _report is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Report with _id {str(_id)} not found.")
-    return _report_control.delete(_id=_id)
+    return _report
 
 
 # Groups
@@ -278,64 +443,98 @@ groups_router = APIRouter()
 
 @groups_router.get("/", response_model=list[schemas.GroupSchema])
 async def get_groups(current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
-                     session_db: Annotated[Session, Depends(get_db)],
+                     session_db: Annotated[AsyncSession, Depends(get_read_db)],
+                     page: Annotated[pagination.PageParams, Depends()],
+                     request: Request,
+                     response: Response,
+                     code_name: str | None = None,
                      ):
-    # TODO: Make handlers for Controllers
+    if pagination.wants_ndjson(request):
+        return ndjson_response(request, lambda _db: controllers.GroupController(_db).stream(
+            page, code_name=code_name))
+    if _not_modified := not_modified(request, response, controllers.GroupController.cache_namespace):
+        return _not_modified
     _group_control = controllers.GroupController(session_db)
-    return _group_control.get()
+    _groups, next_cursor = await _group_control.get_page(page, code_name=code_name)
+    return pagination.page_response(_groups, next_cursor, page, response, schemas.GroupSchema)
 
 
 @groups_router.post("/", response_model=schemas.GroupSchema)
 async def add_group(body: schemas.GroupSchemaCreate,
                     current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
-                    session_db: Annotated[Session, Depends(get_db)],
+                    session_db: Annotated[AsyncSession, Depends(get_db)],
                     ):
     _group_control = controllers.GroupController(session_db)
-    return _group_control.create(body)
+    return await _group_control.create(body)
+
+
+@groups_router.get("/tree", response_model=list[schemas.GroupWithRowsSchema])
+async def get_groups_tree(current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
+                          session_db: Annotated[AsyncSession, Depends(get_read_db)],
+                          request: Request,
+                          response: Response,
+                          ):
+    """All groups with their rows"""
+    if _not_modified := not_modified(request, response, controllers.GroupController.tree_cache_namespace):
+        return _not_modified
+    _group_control = controllers.GroupController(session_db)
+    return pagination.json_list_response(schemas.GroupWithRowsSchema, await _group_control.get_tree(),
+                                         headers=dict(response.headers))
 
 
-@groups_router.get("/{code_name}", response_model=schemas.GroupSchema)
+@groups_router.get("/{code_name}", response_model=schemas.GroupWithRowsSchema | schemas.GroupSchema)
 async def get_group(code_name: str,
                     current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
-                    session_db: Annotated[Session, Depends(get_db)],
+                    session_db: Annotated[AsyncSession, Depends(get_read_db)],
+                    request: Request,
+                    response: Response,
+                    include: Literal["rows"] | None = None,
                     ):
+    """Group by code_name, with include=rows - together with its rows"""
+    namespace = controllers.GroupController.tree_cache_namespace if include == "rows" else \
+        controllers.GroupController.cache_namespace
+    if _not_modified := not_modified(request, response, namespace):
+        return _not_modified
     _group_control = controllers.GroupController(session_db)
-    _groups = _group_control.get(code_name=code_name)
-    if _groups is None:
+    if include == "rows":
+        _groups = await _group_control.get_tree(code_name=code_name)
+    else:
+        _groups = await _group_control.get(code_name=code_name)
+    if not _groups:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Group with code_name {code_name} not found.")
-    return _groups
+    return _groups[0]
 
 
 @groups_router.patch("/", response_model=schemas.GroupSchema)
 async def update_group(_id: int,
                        body: schemas.GroupSchemaUpdate,
                        current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
-                       session_db: Annotated[Session, Depends(get_db)],
+                       session_db: Annotated[AsyncSession, Depends(get_db)],
                        ):
-    updated_group_params = body.model_dump()
+    updated_group_params = body.model_dump(exclude_unset=True, exclude_none=True)
     if updated_group_params == {}:
         raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
                             detail="At least one parameter for group update info should be provided")
     _group_control = controllers.GroupController(session_db)
-    _groups = _group_control.get(_id=_id)
-    if _groups is None:
+    _group = await _group_control.update(_id, **updated_group_params)
+    if _group is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Group with _id {str(_id)} not found.")
-    return _group_control.update(_id, **updated_group_params)
+    return _group
 
 
 @groups_router.delete("/", response_model=schemas.GroupSchema)
 async def delete_group(_id: int,
                         current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
-                        session_db: Annotated[Session, Depends(get_db)],
+                        session_db: Annotated[AsyncSession, Depends(get_db)],
                         ):
     _group_control = controllers.GroupController(session_db)
-    _groups = _group_control.get(_id=_id)
-    if _groups is None:
+    _group = await _group_control.delete(_id=_id)
+    if _group is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Group with _id {str(_id)} not found.")
-    return _group_control.delete(_id=_id)
+    return _group
 
 
 # Group_rows
@@ -343,66 +542,111 @@ group_rows_router = APIRouter()
 
 
 @group_rows_router.get("/", response_model=list[schemas.GroupRowSchema])
-async def get_group_rows(id_group: int,
-                         current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
-                         session_db: Annotated[Session, Depends(get_db)],
+async def get_group_rows(current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
+                         session_db: Annotated[AsyncSession, Depends(get_read_db)],
+                         page: Annotated[pagination.PageParams, Depends()],
+                         request: Request,
+                         response: Response,
+                         id_group: int | None = None,
+                         command_text: str | None = None,
                          ):
-    # TODO: Make handlers for Controllers
+    if pagination.wants_ndjson(request):
+        return ndjson_response(request, lambda _db: controllers.GroupRowController(_db).stream(
+            page, id_group=id_group, command_text=command_text))
+    if _not_modified := not_modified(request, response, controllers.GroupRowController.cache_namespace):
+        return _not_modified
     _group_row_control = controllers.GroupRowController(session_db)
-    return _group_row_control.get(id_group=id_group)
+    _group_rows, next_cursor = await _group_row_control.get_page(page, id_group=id_group, command_text=command_text)
+    return pagination.page_response(_group_rows, next_cursor, page, response, schemas.GroupRowSchema)
 
 
 @group_rows_router.post("/", response_model=schemas.GroupRowSchema)
 async def add_group_row(body: schemas.GroupRowSchemaCreate,
                         current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
-                        session_db: Annotated[Session, Depends(get_db)],
+                        session_db: Annotated[AsyncSession, Depends(get_db)],
                         ):
     _group_row_control = controllers.GroupRowController(session_db)
-    return _group_row_control.create(body)
+    return await _group_row_control.create(body)
+
+
+@group_rows_router.post("/bulk", response_model=list[schemas.BulkItemResultSchema])
+async def add_group_rows(body: list[schemas.GroupRowSchemaCreate],
+                         current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
+                         session_db: Annotated[AsyncSession, Depends(get_db)],
+                         ):
+    check_bulk_size(body)
+    _group_row_control = controllers.GroupRowController(session_db)
+    try:
+        return await _group_row_control.create_many(body)
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="failed to create group rows - " + str(e))
+
+
+@group_rows_router.get("/{_id}/file", response_class=FileResponse)
+async def get_group_row_file(_id: int,
+                             current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
+                             session_db: Annotated[AsyncSession, Depends(get_read_db)],
+                             request: Request,
+                             ):
+    """The group row file, supports Range and If-None-Match"""
+    _group_row_control = controllers.GroupRowController(session_db)
+    _group_rows = await _group_row_control.get(_id=_id)
+    if not _group_rows:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Group row with _id {_id} not found.")
+    return await files.file_response(request, _group_rows[0].file_name)
 
 
-@group_rows_router.get("/{command_text}", response_model=schemas.GroupRowSchema)
+# Declared after the other GET routes: the command is the rest of the path and may contain "/"
+@group_rows_router.get("/{command_text:path}", response_model=schemas.GroupRowSchema)
 async def get_group_row(command_text: str,
                         current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
-                        session_db: Annotated[Session, Depends(get_db)],
+                        session_db: Annotated[AsyncSession, Depends(get_read_db)],
+                        request: Request,
+                        response: Response,
                         ):
-    _group_row_control = controllers.GroupRowController(session_db)
-    _group_rows = _group_row_control.get(command_text=command_text)
-    if _group_rows is None:
+    """Dispatch of the bot command: the row of the command (case-insensitive), the command may be followed
+    by arguments ("/report 2024"). Found in the in-memory command router without database queries"""
+    if _not_modified := not_modified(request, response, controllers.GroupRowController.cache_namespace):
+        return _not_modified
+    await commands.update_command_router(session_db, force=False)
+    _group_row = commands.command_router.match(command_text)
+    if _group_row is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Group with command_text {command_text} not found.")
-    return _group_rows
+    return _group_row
 
 
 @group_rows_router.patch("/", response_model=schemas.GroupRowSchema)
 async def update_group_row(_id: int,
                            body: schemas.GroupRowSchemaUpdate,
                            current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
-                           session_db: Annotated[Session, Depends(get_db)],
+                           session_db: Annotated[AsyncSession, Depends(get_db)],
                            ):
-    updated_group_row_params = body.model_dump()
+    updated_group_row_params = body.model_dump(exclude_unset=True, exclude_none=True)
     if updated_group_row_params == {}:
         raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
                             detail="At least one parameter for grouprow update info should be provided")
     _group_row_control = controllers.GroupRowController(session_db)
-    _group_rows = _group_row_control.get(_id=_id)
-    if _group_rows is None:
+    _group_row = await _group_row_control.update(_id, **updated_group_row_params)
+    if _group_row is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Grouprow with _id {str(_id)} not found.")
-    return _group_row_control.update(_id, **updated_group_row_params)
+    return _group_row
 
 
 @group_rows_router.delete("/", response_model=schemas.GroupRowSchema)
 async def delete_group_row(_id: int,
                            current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
-                           session_db: Annotated[Session, Depends(get_db)],
+                           session_db: Annotated[AsyncSession, Depends(get_db)],
                            ):
     _group_row_control = controllers.GroupRowController(session_db)
-    _group_rows = _group_row_control.get(_id=_id)
-    if _group_rows is None:
+    _group_row = await _group_row_control.delete(_id=_id)
+    if _group_row is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Grouprow with _id {str(_id)} not found.")
-    return _group_row_control.delete(_id=_id)
+    return _group_row
 
 
 # Tasks
@@ -412,29 +656,230 @@ tasks_router = APIRouter()
 @tasks_router.get("/", response_model=list[schemas.TaskSchema])
 async def get_tasks(id_employee: int,
                     current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
-                    session_db: Annotated[Session, Depends(get_db)],
-                    limit: int = 1, offset: int = 0,
+                    session_db: Annotated[AsyncSession, Depends(get_read_db)],
+                    request: Request,
+                    response: Response,
+                    limit: Annotated[int, Query(ge=1, le=Config.PAGE_MAX_LIMIT)] = 1,
+                    offset: Annotated[int, Query(ge=0)] = 0,
+                    after_id: int = 0,
                     ):
-    # TODO: Make handlers for Controllers
+    """Page of employee tasks, the cursor of the next page (if any) is returned in the X-Next-Cursor header
+    and should be passed as after_id. With "Accept: application/x-ndjson" all tasks after after_id are streamed"""
+    if pagination.wants_ndjson(request):
+        return ndjson_response(request, lambda _db: controllers.TaskController(_db).stream(
+            id_employee, after_id=after_id))
     _task_control = controllers.TaskController(session_db)
-    _tasks = _task_control.get(id_employee=id_employee)
+    # One extra row tells whether there is a next page
+    _tasks = await _task_control.get(id_employee=id_employee, limit=limit + 1, offset=offset, after_id=after_id)
     if _tasks is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Tasks with id_employee {id_employee} not found.")
-    return [task for task in _tasks[offset:][:limit]]
+    if len(_tasks) > limit:
+        _tasks = _tasks[:limit]
+        response.headers[pagination.NEXT_CURSOR_HEADER] = str(_tasks[-1].id)
+    return pagination.json_list_response(schemas.TaskSchema, _tasks, headers=dict(response.headers))
+
+
+async def tasks_after(id_employee: int, after_id: int, limit: int = Config.PAGE_MAX_LIMIT) -> list[schemas.TaskSchema]:
+    """Tasks missed by a listener, read from the primary because a replica may not have them yet"""
+    async with SessionLocal() as _db:
+        return await controllers.TaskController(_db).get(id_employee=id_employee, limit=limit, after_id=after_id)
+
+
+@tasks_router.get("/poll", response_model=list[schemas.TaskSchema])
+async def poll_tasks(id_employee: int,
+                     current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
+                     response: Response,
+                     after_id: int = 0,
+                     limit: Annotated[int, Query(ge=1, le=Config.PAGE_MAX_LIMIT)] = Config.PAGE_MAX_LIMIT,
+                     timeout: Annotated[float, Query(ge=0, le=Config.TASK_POLL_MAX_SECONDS)] =
+                     Config.TASK_POLL_MAX_SECONDS,
+                     ):
+    """Long-poll of the employee tasks after after_id: when there are none, waits up to timeout seconds
+    for new tasks. X-Next-Cursor is the after_id of the next poll"""
+    with inbox.task_inbox.subscribe(id_employee) as subscription:
+        _tasks = await tasks_after(id_employee, after_id, limit)
+        if not _tasks and await subscription.wait(timeout):
+            _tasks, overflowed = subscription.take()
+            if overflowed:
+                _tasks = await tasks_after(id_employee, after_id, limit)
+            _tasks = [task for task in _tasks if task.id > after_id][:limit]
+    response.headers[pagination.NEXT_CURSOR_HEADER] = str(_tasks[-1].id if _tasks else after_id)
+    return pagination.json_list_response(schemas.TaskSchema, _tasks, headers=dict(response.headers))
+
+
+@tasks_router.websocket("/stream")
+async def stream_tasks(websocket: WebSocket,
+                       id_employee: int,
+                       token: str,
+                       after_id: int = 0,
+                       ):
+    """Push the employee tasks as JSON text messages: the tasks after after_id first, then new tasks
+    as they are created. Browsers can't set headers of a WebSocket, so the access token is a query parameter"""
+    try:
+        await auth.check_active_user(await auth.check_current_user(token))
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+
+    async def push(subscription: inbox.Subscription):
+        sent = inbox.SentTasks(after_id, Config.TASK_STREAM_SENT_IDS)
+        _tasks = await tasks_after(id_employee, sent.after_id)
+        while True:
+            for task in _tasks:
+                if sent.add(task.id):
+                    await websocket.send_text(task.model_dump_json())
+            if len(_tasks) == Config.PAGE_MAX_LIMIT:
+                # The rest of the missed tasks
+                _tasks = await tasks_after(id_employee, _tasks[-1].id)
+                continue
+            if await subscription.wait(Config.TASK_STREAM_RESYNC_SECONDS):
+                _tasks, overflowed = subscription.take()
+                if not overflowed:
+                    continue
+            # Also reads the sent tasks still in the queue, a task committed later than a higher id is among them
+            _tasks = await tasks_after(id_employee, sent.after_id)
+
+    async def receive():
+        # Messages of the client are not expected, reading them notices the disconnect
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    with inbox.task_inbox.subscribe(id_employee) as subscription:
+        pusher = asyncio.create_task(push(subscription))
+        receiver = asyncio.create_task(receive())
+        try:
+            done, _ = await asyncio.wait([pusher, receiver], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            pusher.cancel()
+            receiver.cancel()
+    if receiver not in done:
+        # The push failed, e.g. the database is not available
+        stream_logger.error("Tasks stream of employee %s failed", id_employee, exc_info=pusher.exception())
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+
+
+@tasks_router.post("/bulk", response_model=list[schemas.BulkItemResultSchema])
+async def add_tasks(body: list[schemas.TaskSchemaCreate],
+                    current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
+                    session_db: Annotated[AsyncSession, Depends(get_db)],
+                    ):
+    check_bulk_size(body)
+    _task_control = controllers.TaskController(session_db)
+    try:
+        return await _task_control.create_many(body)
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="failed to create tasks - " + str(e))
+
+
+@tasks_router.delete("/bulk", response_model=list[schemas.BulkItemResultSchema])
+async def delete_tasks(body: list[int],
+                       current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
+                       session_db: Annotated[AsyncSession, Depends(get_db)],
+                       ):
+    check_bulk_size(body)
+    _task_control = controllers.TaskController(session_db)
+    return await _task_control.delete_many(body)
+
+
+@tasks_router.post("/claim", response_model=schemas.TaskClaimSchema)
+async def claim_tasks(id_employee: int,
+                      current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
+                      session_db: Annotated[AsyncSession, Depends(get_db)],
+                      batch: Annotated[int, Query(ge=1, le=Config.TASK_CLAIM_MAX_BATCH)] = 1,
+                      visibility_seconds: Annotated[int, Query(ge=1, le=Config.TASK_CLAIM_MAX_VISIBILITY_SECONDS)] =
+                      Config.TASK_CLAIM_VISIBILITY_SECONDS,
+                      ):
+    """Claim up to batch tasks of the employee. The tasks should be acknowledged (deleted) with the claim token
+    within visibility_seconds, otherwise they are given to other workers"""
+    _task_control = controllers.TaskController(session_db)
+    return await _task_control.claim(id_employee, batch, visibility_seconds)
+
+
+@tasks_router.post("/ack", response_model=list[schemas.BulkItemResultSchema])
+async def ack_tasks(body: schemas.TaskAckSchema,
+                    current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
+                    session_db: Annotated[AsyncSession, Depends(get_db)],
+                    ):
+    check_bulk_size(body.ids)
+    _task_control = controllers.TaskController(session_db)
+    return await _task_control.ack(body.claim_token, body.ids)
+
+
+@tasks_router.post("/nack", response_model=list[schemas.BulkItemResultSchema])
+async def nack_tasks(body: schemas.TaskNackSchema,
+                     current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
+                     session_db: Annotated[AsyncSession, Depends(get_db)],
+                     ):
+    check_bulk_size(body.ids)
+    _task_control = controllers.TaskController(session_db)
+    return await _task_control.nack(body.claim_token, body.ids, body.delay_seconds)
 
 
 @tasks_router.get("/{_id}", response_model=schemas.TaskSchema)
 async def get_task(_id: int,
                    current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
-                   session_db: Annotated[Session, Depends(get_db)],
+                   session_db: Annotated[AsyncSession, Depends(get_read_db)],
                    ):
     _task_control = controllers.TaskController(session_db)
-    _tasks = _task_control.get(_id=_id)
-    if _tasks is None:
+    _tasks = await _task_control.get(_id=_id)
+    if not _tasks:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Task with _id {_id} not found.")
-    return _tasks
+    return _tasks[0]
+
+
+# Jobs
+jobs_router = APIRouter()
+
+
+@jobs_router.get("/{job_id}", response_model=schemas.JobSchema)
+async def get_job(job_id: str,
+                  current_user: Annotated[schemas.UserSchema, Depends(auth.check_active_user)],
+                  ):
+    job = jobs.report_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Job with id {job_id} not found.")
+    return job
+
+
+profiling_router = APIRouter()
+
+
+@profiling_router.get("/", response_model=schemas.ProfilingStatusSchema)
+async def get_profiling(current_user: Annotated[schemas.UserSchema, Depends(auth.check_admin_user)]):
+    """Settings of the sampling and the slow requests captured with their SQL statements"""
+    return profiling.profiler.status()
+
+
+@profiling_router.post("/", response_model=schemas.ProfilingStatusSchema)
+async def enable_profiling(settings: schemas.ProfilingSettingsSchema,
+                           current_user: Annotated[schemas.UserSchema, Depends(auth.check_admin_user)]):
+    profiling.profiler.enable(settings)
+    return profiling.profiler.status()
+
+
+@profiling_router.delete("/", response_model=schemas.ProfilingStatusSchema)
+async def disable_profiling(current_user: Annotated[schemas.UserSchema, Depends(auth.check_admin_user)]):
+    profiling.profiler.disable()
+    return profiling.profiler.status()
+
+
+@profiling_router.get("/profile")
+async def get_profile(current_user: Annotated[schemas.UserSchema, Depends(auth.check_admin_user)],
+                      output: Literal["pstats", "text"] = "pstats",
+                      sort: Literal["cumulative", "tottime", "calls"] = "cumulative",
+                      limit: Annotated[int, Query(ge=1, le=1000)] = 50):
+    """Aggregated cProfile of the slow requests: pstats file (python -m pstats support.prof) or its text summary"""
+    if not profiling.profiler.has_profile():
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No requests were profiled.")
+    if output == "text":
+        return Response(profiling.profiler.text(sort, limit), media_type="text/plain")
+    return Response(profiling.profiler.dump(), media_type="application/octet-stream",
+                    headers={"Content-Disposition": 'attachment; filename="support.prof"'})
 
 
 main_api_router.include_router(users_router, prefix="/users", tags=["Users"])
@@ -442,6 +887,8 @@ main_api_router.include_router(reports_router, prefix="/reports", tags=["Reports
 main_api_router.include_router(groups_router, prefix="/groups", tags=["Groups"])
 main_api_router.include_router(group_rows_router, prefix="/group_rows", tags=["Grouprows"])
 main_api_router.include_router(tasks_router, prefix="/tasks", tags=["Tasks"])
+main_api_router.include_router(jobs_router, prefix="/jobs", tags=["Jobs"])
+main_api_router.include_router(profiling_router, prefix="/profiling", tags=["Profiling"])
 app.include_router(main_api_router)
 
 if __name__ == "__main__":
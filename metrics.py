@@ -0,0 +1,214 @@
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from starlette.datastructures import MutableHeaders
+
+import cache
+import files
+from config import Config
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple, *extra: str) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Prometheus counter by the label values"""
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_labels(self.labels, values)} {value}" for values, value in sorted(self._values.items())]
+        return lines
+
+
+class Histogram:
+    """Prometheus histogram by the label values: counts of the observations by bucket, their sum and count"""
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = Config.METRICS_LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # Label values -> [count of every bucket (not cumulative), count above the last bucket, sum]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for values, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                bucket = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, values, bucket)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, values)} {series[-1]}")
+            lines.append(f"{self.name}_count{_labels(self.labels, values)} {cumulative}")
+        return lines
+
+
+class RequestTiming:
+    """Database and bcrypt work of the current request, filled by the SQLAlchemy event hooks and auth"""
+    __slots__ = ("db_queries", "db_seconds", "pool_wait_seconds", "bcrypt_seconds", "checkout_started")
+
+    def __init__(self):
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.pool_wait_seconds = 0.0
+        self.bcrypt_seconds = 0.0
+        # Start of the first statement of a session, before its connection is taken from the pool
+        self.checkout_started: float | None = None
+
+    def server_timing(self, total_seconds: float) -> str:
+        parts = [f"app;dur={total_seconds * 1000:.1f}",
+                 f'db;dur={self.db_seconds * 1000:.1f};desc="{self.db_queries} queries"']
+        if self.pool_wait_seconds:
+            parts.append(f"pool;dur={self.pool_wait_seconds * 1000:.1f}")
+        if self.bcrypt_seconds:
+            parts.append(f"bcrypt;dur={self.bcrypt_seconds * 1000:.1f}")
+        return ", ".join(parts)
+
+
+# Timing of the request handled by the current task, None outside of the HTTP requests
+request_timing: ContextVar[RequestTiming | None] = ContextVar("request_timing", default=None)
+
+requests_total = Counter("support_http_requests_total", "HTTP requests by route and status code",
+                         ("method", "route", "status"))
+request_seconds = Histogram("support_http_request_duration_seconds", "Latency of the HTTP requests by route",
+                            ("method", "route"))
+request_db_queries = Histogram("support_http_request_db_queries", "Database statements executed per HTTP request",
+                               ("method", "route"), buckets=Config.METRICS_QUERY_COUNT_BUCKETS)
+request_db_seconds = Histogram("support_http_request_db_seconds", "Database time per HTTP request",
+                               ("method", "route"))
+query_seconds = Histogram("support_db_query_duration_seconds", "Duration of the database statements")
+pool_wait_seconds = Histogram("support_db_pool_checkout_wait_seconds",
+                              "Wait for a connection from the pool at the first statement of a session")
+bcrypt_seconds = Histogram("support_bcrypt_duration_seconds", "Duration of the password hashing and verification",
+                           ("operation",))
+
+
+def session_execute_started():
+    """Statement of a session is executed, its connection may be taken from the pool next"""
+    timing = request_timing.get()
+    if timing is not None and timing.checkout_started is None:
+        timing.checkout_started = time.perf_counter()
+
+
+def connection_checked_out():
+    timing = request_timing.get()
+    if timing is not None and timing.checkout_started is not None:
+        elapsed = time.perf_counter() - timing.checkout_started
+        timing.checkout_started = None
+        timing.pool_wait_seconds += elapsed
+        pool_wait_seconds.observe(elapsed)
+
+
+def query_started():
+    """Statement is sent to the database, so the session already has its connection"""
+    timing = request_timing.get()
+    if timing is not None:
+        timing.checkout_started = None
+
+
+def observe_query(elapsed: float):
+    query_seconds.observe(elapsed)
+    timing = request_timing.get()
+    if timing is not None:
+        timing.db_queries += 1
+        timing.db_seconds += elapsed
+
+
+def observe_bcrypt(operation: str, elapsed: float):
+    bcrypt_seconds.observe(elapsed, operation)
+    timing = request_timing.get()
+    if timing is not None:
+        timing.bcrypt_seconds += elapsed
+
+
+def _cache_lines() -> list[str]:
+    """Hits, misses and hit ratio of the catalogues cache by table and of the files cache"""
+    stats = {("catalog", namespace): counters for namespace, counters in cache.catalog_cache.stats().items()}
+    stats["files", ""] = files.file_cache.stats()
+    hits = Counter("support_cache_hits_total", "Cache hits", ("cache", "namespace"))
+    misses = Counter("support_cache_misses_total", "Cache misses", ("cache", "namespace"))
+    ratios = ["# HELP support_cache_hit_ratio Share of the cache lookups that hit",
+              "# TYPE support_cache_hit_ratio gauge"]
+    for values, counters in sorted(stats.items()):
+        hits.inc(*values, amount=counters["hits"])
+        misses.inc(*values, amount=counters["misses"])
+        lookups = counters["hits"] + counters["misses"]
+        ratios.append(f"support_cache_hit_ratio{_labels(hits.labels, values)} "
+                      f"{counters['hits'] / lookups if lookups else 0}")
+    return hits.render() + misses.render() + ratios
+
+
+def render() -> str:
+    """All metrics in the Prometheus text format. Every server process has its own metrics,
+    like the caches, so they are scraped per process"""
+    lines = []
+    for metric in (requests_total, request_seconds, request_db_queries, request_db_seconds, query_seconds,
+                   pool_wait_seconds, bcrypt_seconds):
+        lines += metric.render()
+    lines += _cache_lines()
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """ASGI middleware measuring the HTTP requests by route (path template, so ids do not make new series).
+
+    The timings of the request so far are sent in the Server-Timing header of the response,
+    the work done while the body is streamed is only counted in the metrics.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timing = RequestTiming()
+        token = request_timing.set(timing)
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if Config.METRICS_SERVER_TIMING:
+                    MutableHeaders(scope=message).append("Server-Timing",
+                                                         timing.server_timing(time.perf_counter() - start))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_timing.reset(token)
+            elapsed = time.perf_counter() - start
+            route = scope.get("route")
+            labels = (scope["method"], route.path if route is not None else "unmatched")
+            requests_total.inc(*labels, status_code)
+            request_seconds.observe(elapsed, *labels)
+            request_db_queries.observe(timing.db_queries, *labels)
+            request_db_seconds.observe(timing.db_seconds, *labels)
@@ -0,0 +1,26 @@
+"""Task claims
+
+Revision ID: 05febc8ea097
+Revises: 869e60dd2057
+Create Date: 2026-10-18 10:12:41.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '05febc8ea097'
+down_revision = '869e60dd2057'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('dh_tasks', sa.Column('claimed_until', sa.DateTime(), nullable=True))
+    op.add_column('dh_tasks', sa.Column('claim_token', sa.String(length=32), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('dh_tasks', 'claim_token')
+    op.drop_column('dh_tasks', 'claimed_until')
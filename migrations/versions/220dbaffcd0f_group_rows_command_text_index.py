@@ -0,0 +1,24 @@
+"""Group rows command_text index
+
+Revision ID: 220dbaffcd0f
+Revises: 05febc8ea097
+Create Date: 2026-10-18 11:03:27.518046
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '220dbaffcd0f'
+down_revision = '05febc8ea097'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_group_rows_command_text', 'group_rows', ['command_text'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_group_rows_command_text', table_name='group_rows')
@@ -0,0 +1,33 @@
+"""Lookup indexes
+
+Revision ID: cdc9dd5e4f1f
+Revises: 220dbaffcd0f
+Create Date: 2026-10-18 11:47:05.963120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'cdc9dd5e4f1f'
+down_revision = '220dbaffcd0f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_users_role', 'users', ['role'], unique=False)
+    op.create_index('ix_reports_code_name', 'reports', ['code_name'], unique=False)
+    op.create_index('ix_groups_code_name', 'groups', ['code_name'], unique=False)
+    op.create_index('ix_group_rows_id_group', 'group_rows', ['id_group'], unique=False)
+    op.create_index('ix_dh_tasks_id_employee_id', 'dh_tasks', ['id_employee', 'id'], unique=False,
+                    mssql_include=['last_context', 'message_text', 'claimed_until'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_dh_tasks_id_employee_id', table_name='dh_tasks')
+    op.drop_index('ix_group_rows_id_group', table_name='group_rows')
+    op.drop_index('ix_groups_code_name', table_name='groups')
+    op.drop_index('ix_reports_code_name', table_name='reports')
+    op.drop_index('ix_users_role', table_name='users')
@@ -4,11 +4,13 @@ from sqlalchemy import (
     Enum,
     String,
     TIMESTAMP,
+    DateTime,
     ForeignKey,
     JSON,
     Boolean,
     MetaData,
     Identity,
+    Index,
 )
 from sqlalchemy.orm import DeclarativeBase, relationship, mapped_column
 from sqlalchemy.ext.asyncio import AsyncAttrs
@@ -29,7 +31,7 @@ class UserModel(Base):
     id_employee = mapped_column(Integer, nullable=False)
     disabled = mapped_column(Boolean, default=True, nullable=False)
     password = mapped_column(String(255), nullable=False)
-    role = mapped_column(Enum(RoleSchema), default="user", nullable=False)
+    role = mapped_column(Enum(RoleSchema), default="user", nullable=False, index=True)
 
 
 class ReportModel(Base):
@@ -38,7 +40,7 @@ class ReportModel(Base):
     id = mapped_column(Integer, primary_key=True, autoincrement=True)  # Identity(start=1, increment=1)
     name = mapped_column(String(50), nullable=False)
     description = mapped_column(String(255), nullable=False)
-    code_name = mapped_column(String(50), nullable=False)
+    code_name = mapped_column(String(50), nullable=False, index=True)
     file_name = mapped_column(String(255), nullable=False)
 
 
@@ -48,18 +50,18 @@ class GroupModel(Base):
     id = mapped_column(Integer, primary_key=True, autoincrement=True)  # Identity(start=1, increment=1)
     name = mapped_column(String(50), nullable=False)
     description = mapped_column(String(255), nullable=False)
-    code_name = mapped_column(String(50), nullable=False)
+    code_name = mapped_column(String(50), nullable=False, index=True)
 
-    rows = relationship('GroupRowModel', back_populates='group')
+    rows = relationship('GroupRowModel', back_populates='group', order_by='GroupRowModel.id')
 
 
 class GroupRowModel(Base):
     __tablename__ = "group_rows"
 
     id = mapped_column(Integer, primary_key=True, autoincrement=True)  # Identity(start=1, increment=1)
-    id_group = mapped_column(Integer, ForeignKey('groups.id'), nullable=False)
+    id_group = mapped_column(Integer, ForeignKey('groups.id'), nullable=False, index=True)
     name = mapped_column(String(255), nullable=False)
-    command_text = mapped_column(String(50), nullable=False)
+    command_text = mapped_column(String(50), nullable=False, index=True)
     file_name = mapped_column(String(255), nullable=False)
 
     group = relationship('GroupModel', back_populates='rows')
@@ -67,10 +69,18 @@ class GroupRowModel(Base):
 
 class TaskModel(Base):
     __tablename__ = "dh_tasks"
+    __table_args__ = (
+        # Employee queue in id order: listing, streaming and claiming of the tasks are served by this index only
+        Index("ix_dh_tasks_id_employee_id", "id_employee", "id",
+              mssql_include=["last_context", "message_text", "claimed_until"]),
+    )
 
     id = mapped_column(Integer, primary_key=True, autoincrement=True)  # Identity(start=1, increment=1)
     id_employee = mapped_column(Integer, ForeignKey('employees.id'), nullable=False)
     last_context = mapped_column(String(50), nullable=False)
     message_text = mapped_column(String(255), nullable=False)
+    # Claim of the task by a worker: the task is hidden from other workers till claimed_until
+    claimed_until = mapped_column(DateTime, nullable=True)
+    claim_token = mapped_column(String(32), nullable=True)
 
     #employee = relationship('EmployeeModel', back_populates='tasks')
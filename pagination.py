@@ -0,0 +1,132 @@
+from functools import cache
+from typing import Annotated, AsyncIterator
+
+from fastapi import HTTPException, Query, Request, Response, status
+from pydantic import BaseModel, TypeAdapter
+from pydantic_core import to_json
+from sqlalchemy import Row, Select, select
+from typing_extensions import TypedDict
+
+from config import Config
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+JSON_MEDIA_TYPE = "application/json"
+
+
+class PageParams:
+    """Common query parameters of the list endpoints.
+
+    limit - max number of returned rows (all rows if not set),
+    cursor - value of the X-Next-Cursor header of the previous page,
+    fields - comma separated names of the returned fields (all fields if not set)
+    """
+    def __init__(self,
+                 limit: Annotated[int | None, Query(ge=1, le=Config.PAGE_MAX_LIMIT)] = None,
+                 cursor: str | None = None,
+                 fields: str | None = None,
+                 ):
+        self.limit = limit
+        self.cursor = cursor
+        self.fields = [field.strip() for field in fields.split(",") if field.strip()] if fields else []
+
+
+def equal_filters(model, filters: dict) -> list:
+    """Equality conditions for the filters which are set"""
+    return [getattr(model, name) == value for name, value in filters.items() if value is not None]
+
+
+def page_query(columns: dict, key: str, page: PageParams, *where) -> Select:
+    """Select the requested columns of one page ordered by the key column.
+
+    columns - column expressions by field name, the key field is always returned because the next cursor is built on it
+    """
+    if page.fields:
+        unknown_fields = set(page.fields) - set(columns)
+        if unknown_fields:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                detail=f"Unknown fields: {', '.join(sorted(unknown_fields))}")
+        names = [key] + [name for name in page.fields if name != key]
+    else:
+        names = list(columns)
+    key_column = columns[key]
+
+    query = select(*[columns[name] for name in names]).where(*where).order_by(key_column)
+    if page.cursor is not None:
+        try:
+            after = key_column.type.python_type(page.cursor)
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                detail=f"Wrong cursor {page.cursor}")
+        query = query.where(key_column > after)
+    if page.limit:
+        # One extra row tells whether there is a next page
+        query = query.limit(page.limit + 1)
+    return query
+
+
+def split_page(rows, key: str, page: PageParams) -> tuple[list[Row], str | None]:
+    """Page rows and the cursor of the next page"""
+    items = list(rows)
+    if page.limit and len(items) > page.limit:
+        items = items[:page.limit]
+        return items, str(getattr(items[-1], key))
+    return items, None
+
+
+@cache
+def rows_adapter(schema: type[BaseModel]) -> TypeAdapter:
+    """Validator of the list of rows with the schema fields.
+
+    Rows are validated as typed dicts: the field types are checked and unknown keys are dropped like the schema does,
+    but no schema instance is built per row.
+    """
+    row_type = TypedDict(schema.__name__, {name: field.annotation for name, field in schema.model_fields.items()})
+    return TypeAdapter(list[row_type])
+
+
+@cache
+def list_adapter(schema: type[BaseModel]) -> TypeAdapter:
+    """Serializer of the list of schema instances"""
+    return TypeAdapter(list[schema])
+
+
+def json_rows_response(schema: type[BaseModel], rows: list[Row], headers: dict | None = None) -> Response:
+    """JSON response with the list of rows validated against the schema.
+
+    The returned Response skips the response_model of the route, which would build a schema instance per row,
+    validate it again and encode it through jsonable_encoder, the rows are validated once and dumped by pydantic-core.
+    """
+    adapter = rows_adapter(schema)
+    content = adapter.dump_json(adapter.validate_python([row._asdict() for row in rows]))
+    return Response(content=content, media_type=JSON_MEDIA_TYPE, headers=headers)
+
+
+def json_list_response(schema: type[BaseModel], items: list[BaseModel], headers: dict | None = None) -> Response:
+    """JSON response with the list of schema instances, dumped without the response_model validation"""
+    return Response(content=list_adapter(schema).dump_json(items), media_type=JSON_MEDIA_TYPE, headers=headers)
+
+
+def page_response(items: list[Row], next_cursor: str | None, page: PageParams, response: Response,
+                  schema: type[BaseModel]) -> Response:
+    """Page result of the route: projected rows are dumped as is, full rows are validated against the schema"""
+    if next_cursor is not None:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    if page.fields:
+        return Response(content=to_json([row._asdict() for row in items]), media_type=JSON_MEDIA_TYPE,
+                        headers=dict(response.headers))
+    return json_rows_response(schema, items, headers=dict(response.headers))
+
+
+def wants_ndjson(request: Request) -> bool:
+    """The client asked to stream the listing as newline delimited JSON"""
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+async def stream_rows(db_session, query: Select, limit: int | None = None) -> AsyncIterator[dict]:
+    """Rows of the query as dicts, read from a server-side cursor in batches of Config.STREAM_BATCH_SIZE"""
+    if limit:
+        query = query.limit(limit)
+    result = await db_session.stream(query.execution_options(yield_per=Config.STREAM_BATCH_SIZE))
+    async for row in result:
+        yield row._asdict()
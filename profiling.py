@@ -0,0 +1,170 @@
+import cProfile
+import io
+import marshal
+import pstats
+import random
+import time
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+
+from starlette.routing import Match
+
+import schemas
+from config import Config
+
+# SQL statements of the sampled request with their durations, None when the request is not sampled
+request_statements: ContextVar[list[tuple[str, float]] | None] = ContextVar("request_statements", default=None)
+
+
+def record_statement(statement: str, elapsed: float):
+    statements = request_statements.get()
+    if statements is not None and len(statements) < Config.PROFILING_MAX_STATEMENTS:
+        statements.append((statement, elapsed))
+
+
+class Profiler:
+    """Profiler of the slow requests, enabled at runtime for some routes or a share of the requests.
+
+    Sampled requests are run under cProfile with their SQL statements recorded. The requests slower than
+    the threshold are kept (the last max_requests) and their profiles are added to the aggregated pstats,
+    the faster ones are dropped. cProfile follows the event loop thread, so one request is profiled at once
+    and its profile also has the other requests served by the loop meanwhile; the next sampled requests
+    only get their statements recorded until it finishes. When disabled a request costs one check.
+    """
+    def __init__(self, max_requests: int):
+        self.settings: schemas.ProfilingSettingsSchema | None = None
+        self.enabled_until: datetime | None = None
+        self.requests: deque[schemas.ProfiledRequestSchema] = deque(maxlen=max_requests)
+        self.sampled = 0
+        self.profiled = 0
+        self._until = 0.0
+        self._stats: pstats.Stats | None = None
+        self._profiling = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.settings is not None and time.monotonic() < self._until
+
+    def enable(self, settings: schemas.ProfilingSettingsSchema):
+        """Start a new sampling, the results of the previous one are dropped"""
+        duration = min(settings.duration_seconds, Config.PROFILING_MAX_SECONDS)
+        self.settings = settings.model_copy(update={"duration_seconds": duration})
+        self._until = time.monotonic() + duration
+        self.enabled_until = datetime.utcnow() + timedelta(seconds=duration)
+        self.requests.clear()
+        self.sampled = 0
+        self.profiled = 0
+        self._stats = None
+
+    def disable(self):
+        """Stop the sampling, the results are kept for download"""
+        self.settings = None
+        self.enabled_until = None
+        self._until = 0.0
+
+    def status(self) -> schemas.ProfilingStatusSchema:
+        enabled = self.enabled
+        return schemas.ProfilingStatusSchema(enabled=enabled,
+                                             settings=self.settings if enabled else None,
+                                             enabled_until=self.enabled_until if enabled else None,
+                                             sampled=self.sampled,
+                                             profiled=self.profiled,
+                                             requests=list(self.requests),
+                                             )
+
+    def should_sample(self, scope) -> bool:
+        settings = self.settings
+        if settings is None or random.random() >= settings.sample_rate:
+            return False
+        if not settings.routes:
+            return True
+        # The middleware runs before the routing, so the route is found here the same way
+        for route in scope["app"].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.name in settings.routes or getattr(route, "path", None) in settings.routes
+        return False
+
+    def start_profile(self) -> cProfile.Profile | None:
+        """Profile of the request, None while another request is profiled"""
+        if self._profiling:
+            return None
+        self._profiling = True
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def finish(self, scope, status_code: int, started_at: datetime, elapsed: float,
+               profile: cProfile.Profile | None, statements: list[tuple[str, float]]):
+        if profile is not None:
+            profile.disable()
+            self._profiling = False
+        self.sampled += 1
+        settings = self.settings
+        if settings is None or elapsed * 1000 < settings.threshold_ms:
+            return
+        if profile is not None:
+            self.profiled += 1
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+        route = scope.get("route")
+        self.requests.append(schemas.ProfiledRequestSchema(
+            method=scope["method"],
+            route=route.path if route is not None else "unmatched",
+            path=scope["path"],
+            status=status_code,
+            started_at=started_at,
+            duration_ms=elapsed * 1000,
+            profiled=profile is not None,
+            statements=[schemas.ProfiledStatementSchema(statement=statement, duration_ms=duration * 1000)
+                        for statement, duration in statements],
+        ))
+
+    def has_profile(self) -> bool:
+        return self._stats is not None
+
+    def dump(self) -> bytes:
+        """Aggregated profile in the format of pstats.Stats.dump_stats (for pstats, snakeviz and similar)"""
+        return marshal.dumps(self._stats.stats)
+
+    def text(self, sort: str, limit: int) -> str:
+        stream = io.StringIO()
+        self._stats.stream = stream
+        self._stats.sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+
+profiler = Profiler(max_requests=Config.PROFILING_MAX_REQUESTS)
+
+
+class ProfilingMiddleware:
+    """ASGI middleware running the requests sampled by the profiler under it"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not profiler.enabled or not profiler.should_sample(scope):
+            await self.app(scope, receive, send)
+            return
+        statements = []
+        token = request_statements.set(statements)
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        started_at = datetime.utcnow()
+        start = time.perf_counter()
+        profile = profiler.start_profile()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            request_statements.reset(token)
+            profiler.finish(scope, status_code, started_at, elapsed, profile, statements)
@@ -4,7 +4,9 @@ from fastapi import HTTPException, status
 from datetime import datetime
 from enum import Enum
 from typing import List, Optional
-from pydantic import BaseModel, field_validator, ConfigDict, constr
+from pydantic import BaseModel, Field, field_validator, ConfigDict, constr
+
+from config import Config
 
 LETTER_MATCH_PATTERN = re.compile(r"^[а-яА-Яa-zA-Z\-]+$")
 
@@ -103,6 +105,10 @@ class GroupRowSchema(BaseModel):
     file_name: str
 
 
+class GroupWithRowsSchema(GroupSchema):
+    rows: list[GroupRowSchema]
+
+
 class GroupRowSchemaCreate(BaseModel):
     id_group: int
     name: str
@@ -113,8 +119,9 @@ class GroupRowSchemaCreate(BaseModel):
 class GroupRowSchemaUpdate(BaseModel):
     model_config = ConfigDict(from_attributes=True)
     id_group: int | None
-    description: str | None
-    code_name: str | None
+    name: str | None
+    command_text: str | None
+    file_name: str | None
 
 
 class ReportSchema(BaseModel):
@@ -141,6 +148,14 @@ class ReportSchemaUpdate(BaseModel):
     file_name: str | None
 
 
+class ReportSchemaBulkUpdate(BaseModel):
+    id: int
+    name: str | None = None
+    description: str | None = None
+    code_name: str | None = None
+    file_name: str | None = None
+
+
 class TaskSchema(BaseModel):
     model_config = ConfigDict(from_attributes=True)
     id: int
@@ -155,9 +170,87 @@ class TaskSchemaCreate(BaseModel):
     message_text: str
 
 
+class TaskClaimSchema(BaseModel):
+    claim_token: str
+    claimed_until: datetime
+    tasks: list[TaskSchema]
+
+
+class TaskAckSchema(BaseModel):
+    claim_token: str
+    ids: list[int]
+
+
+class TaskNackSchema(TaskAckSchema):
+    delay_seconds: int = Field(0, ge=0, le=Config.TASK_CLAIM_MAX_VISIBILITY_SECONDS)
+
+
 class TaskSchemaUpdate(BaseModel):
     model_config = ConfigDict(from_attributes=True)
     id_employee: int | None
     last_context: str | None
     message_text: str | None
 
+
+class BulkItemResultSchema(BaseModel):
+    index: int
+    ok: bool
+    id: int | None = None
+    detail: str | None = None
+
+
+class JobStatusSchema(Enum):
+    queued = "queued"
+    running = "running"
+    done = "done"
+    failed = "failed"
+
+
+class ReportRunSchema(BaseModel):
+    params: dict[str, str | int | float | bool | None] = {}
+
+
+class JobSchema(BaseModel):
+    id: str
+    code_name: str
+    file_name: str
+    params: dict[str, str | int | float | bool | None] = {}
+    status: JobStatusSchema = JobStatusSchema.queued
+    created_at: datetime
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+    size: int | None = None
+    error: str | None = None
+
+
+class ProfilingSettingsSchema(BaseModel):
+    # Names of the endpoints (get_tasks) or route paths (/tasks/{_id}), all routes when empty
+    routes: list[str] = []
+    sample_rate: float = Field(1.0, ge=0, le=1)
+    threshold_ms: float = Field(500, ge=0)
+    duration_seconds: int = Field(600, gt=0)
+
+
+class ProfiledStatementSchema(BaseModel):
+    statement: str
+    duration_ms: float
+
+
+class ProfiledRequestSchema(BaseModel):
+    method: str
+    route: str
+    path: str
+    status: int
+    started_at: datetime
+    duration_ms: float
+    profiled: bool
+    statements: list[ProfiledStatementSchema] = []
+
+
+class ProfilingStatusSchema(BaseModel):
+    enabled: bool
+    settings: ProfilingSettingsSchema | None = None
+    enabled_until: datetime | None = None
+    sampled: int = 0
+    profiled: int = 0
+    requests: list[ProfiledRequestSchema] = []
@@ -0,0 +1,38 @@
+import os
+import tempfile
+
+# Two SQLite files stand in for the primary and the replica, settings are read when config is imported
+_directory = tempfile.mkdtemp(prefix="support-tests-")
+os.environ["SUPPORT_DATABASE_URL"] = f"sqlite+aiosqlite:///{_directory}/primary.db"
+os.environ["SUPPORT_DATABASE_REPLICA_URLS"] = f"sqlite+aiosqlite:///{_directory}/replica.db"
+
+import pytest
+import sqlalchemy as sa
+
+import cache
+import database
+import models
+from config import Config
+
+# dh_tasks references employees, which is not mapped by the models
+employees = sa.Table("employees", models.Base.metadata, sa.Column("id", sa.Integer, primary_key=True))
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def databases(monkeypatch):
+    """Empty primary and replica databases with the tables of the models and a clean catalogue cache"""
+    monkeypatch.setattr(cache, "catalog_cache", cache.LocalCache(max_size=Config.CACHE_MAX_SIZE,
+                                                                 ttl=Config.CACHE_TTL_SECONDS))
+    for engine in [database.engine, *database.replica_engines]:
+        async with engine.begin() as connection:
+            await connection.run_sync(models.Base.metadata.drop_all)
+            await connection.run_sync(models.Base.metadata.create_all)
+            await connection.execute(sa.insert(employees), [{"id": 1}, {"id": 2}])
+    yield
+    for engine in [database.engine, *database.replica_engines]:
+        await engine.dispose()
@@ -0,0 +1,95 @@
+import time
+
+import pytest
+
+import auth
+import controllers
+import database
+import schemas
+
+
+def make_user(user_name: str, role: str = "user") -> schemas.UserSchema:
+    return schemas.UserSchema(user_name=user_name, disabled=False, role=role, hashed_password="")
+
+
+@pytest.fixture
+def token_cache():
+    auth.token_cache.clear()
+    yield auth.token_cache
+    auth.token_cache.clear()
+
+
+def test_token_is_cached_until_it_expires(token_cache):
+    user = make_user("alice")
+    token_cache.put("token", user, time.time() + 60)
+    assert token_cache.get("token") == user
+    token_cache.put("expired", user, time.time() - 1)
+    assert token_cache.get("expired") is None
+    assert token_cache.get("unknown") is None
+
+
+def test_least_recently_used_token_is_dropped_over_max_size():
+    token_cache = auth.TokenCache(max_size=2)
+    exp = time.time() + 60
+    token_cache.put("first", make_user("alice"), exp)
+    token_cache.put("second", make_user("bob"), exp)
+    token_cache.get("first")
+    token_cache.put("third", make_user("carol"), exp)
+    assert token_cache.get("second") is None
+    assert token_cache.get("first") is not None and token_cache.get("third") is not None
+
+
+def test_tokens_of_a_changed_user_are_dropped(token_cache):
+    directory = auth.UserDirectory(ttl=60)
+    directory.load([make_user("alice"), make_user("bob")])
+    exp = time.time() + 60
+    token_cache.put("alice-1", directory.get("alice"), exp)
+    token_cache.put("alice-2", directory.get("alice"), exp)
+    token_cache.put("bob", directory.get("bob"), exp)
+
+    directory.put(make_user("alice", role="admin"))
+    assert token_cache.get("alice-1") is None and token_cache.get("alice-2") is None
+    assert token_cache.get("bob") is not None
+
+    directory.remove("bob")
+    assert token_cache.get("bob") is None
+
+
+def test_tokens_are_dropped_when_the_directory_is_reloaded(token_cache):
+    directory = auth.UserDirectory(ttl=60)
+    directory.load([make_user("alice")])
+    token_cache.put("alice", directory.get("alice"), time.time() + 60)
+    directory.load([make_user("alice", role="admin")])
+    assert token_cache.get("alice") is None
+    assert [user.user_name for user in directory.with_role("admin")] == ["alice"]
+
+
+@pytest.fixture
+def users_directory(monkeypatch) -> auth.UserDirectory:
+    """Directory of this server process, empty like before the users are created by another one"""
+    directory = auth.UserDirectory(ttl=60)
+    monkeypatch.setattr(auth, "users_directory", directory)
+    return directory
+
+
+@pytest.mark.anyio
+async def test_user_created_by_another_process_can_log_in(databases, users_directory):
+    async with database.SessionLocal() as session_db:
+        await controllers.UserController(session_db).create(schemas.UserSchemaCreate(user_name="alice",
+                                                                                     password="secret"))
+    users_directory.load([])
+    assert await auth.authenticate_user("alice", "wrong") is False
+    assert (await auth.authenticate_user("alice", "secret")).user_name == "alice"
+    assert users_directory.get("alice") is not None
+    assert await auth.authenticate_user("bob", "secret") is False
+
+
+@pytest.mark.anyio
+async def test_password_changed_by_another_process_is_used(databases, users_directory):
+    async with database.SessionLocal() as session_db:
+        _user = controllers.UserController(session_db)
+        await _user.create(schemas.UserSchemaCreate(user_name="alice", password="secret"))
+        cached_user = users_directory.get("alice")
+        await _user.update("alice", password="changed")
+    users_directory.put(cached_user)
+    assert (await auth.authenticate_user("alice", "changed")).user_name == "alice"
@@ -0,0 +1,77 @@
+import httpx
+import pytest
+
+import auth
+import commands
+import controllers
+import database
+import schemas
+
+
+def make_row(_id: int, command_text: str) -> schemas.GroupRowSchema:
+    return schemas.GroupRowSchema(id=_id, id_group=1, name=f"Row {_id}", command_text=command_text,
+                                  file_name=f"row{_id}.xlsx")
+
+
+@pytest.fixture
+def router() -> commands.CommandRouter:
+    router = commands.CommandRouter(ttl=60)
+    router.load([make_row(1, "/report"), make_row(2, "/report sales"), make_row(3, "/Help ")])
+    return router
+
+
+def test_exact_command_is_matched_case_insensitive(router):
+    assert router.match("/report").id == 1
+    assert router.match(" /HELP").id == 3
+    assert router.match("/unknown") is None
+
+
+def test_longest_command_followed_by_arguments_is_matched(router):
+    assert router.match("/report 2024").id == 1
+    assert router.match("/report sales 2024").id == 2
+    assert router.match("/reports") is None
+    assert router.match("/rep") is None
+
+
+def test_first_row_of_a_shared_command_is_used(router):
+    router.put(make_row(0, "/help"))
+    assert router.match("/help").id == 0
+    router.remove(0)
+    assert router.match("/help").id == 3
+
+
+def test_changed_and_removed_commands_are_not_matched(router):
+    router.put(make_row(2, "/sales"))
+    assert router.match("/report sales 2024").id == 1
+    assert router.match("/sales").id == 2
+    router.remove(1)
+    assert router.match("/report 2024") is None
+    router.remove(2)
+    router.remove(3)
+    assert router.match("/sales") is None
+    # Branches of the removed commands are pruned
+    assert router._trie == {}
+
+
+@pytest.mark.anyio
+async def test_slash_command_with_arguments_is_dispatched(databases, monkeypatch):
+    try:
+        import main
+    except ImportError as err:
+        # main imports pyodbc, which needs the ODBC driver manager library
+        pytest.skip(f"main can't be imported: {err}")
+
+    async with database.SessionLocal() as session_db:
+        group = await controllers.GroupController(session_db).create(
+            schemas.GroupSchemaCreate(name="Reports", description="", code_name="reports"))
+        group_row = await controllers.GroupRowController(session_db).create(
+            schemas.GroupRowSchemaCreate(id_group=group.id, name="Report", command_text="/report",
+                                         file_name="report.xlsx"))
+        await commands.update_command_router(session_db)
+    monkeypatch.setitem(main.app.dependency_overrides, auth.check_active_user,
+                        lambda: schemas.UserSchema(user_name="bot", disabled=False, role="user", hashed_password=""))
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+        response = await client.get("/group_rows/%2Freport%202024")
+        assert response.status_code == 200
+        assert response.json() == group_row.model_dump()
+        assert (await client.get("/group_rows//unknown")).status_code == 404
@@ -0,0 +1,29 @@
+import pytest
+from fastapi import HTTPException
+
+import files
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=900-5000", (900, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    (" bytes=5-5 ", (5, 5)),
+])
+def test_single_range(header, expected):
+    assert files.parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["", "bytes=-", "items=0-10", "bytes=0-10,20-30", "bytes=a-b"])
+def test_whole_file_is_sent_for_missing_or_unsupported_ranges(header):
+    assert files.parse_range(header, 1000) is None
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=50-10", "bytes=-0"])
+def test_range_outside_the_file_is_not_satisfiable(header):
+    with pytest.raises(HTTPException) as error:
+        files.parse_range(header, 1000)
+    assert error.value.status_code == 416
+    assert error.value.headers["Content-Range"] == "bytes */1000"
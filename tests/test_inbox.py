@@ -0,0 +1,20 @@
+import inbox
+
+
+def test_task_published_after_a_higher_id_is_sent():
+    sent = inbox.SentTasks(after_id=5, max_size=3)
+    assert sent.add(10)
+    assert sent.add(9)
+    assert not sent.add(10)
+    assert not sent.add(5)
+
+
+def test_dropped_ids_are_not_read_again():
+    sent = inbox.SentTasks(after_id=0, max_size=2)
+    for task_id in (2, 1, 3):
+        assert sent.add(task_id)
+    assert sent.after_id == 2
+    assert not sent.add(2)
+    assert sent.add(4)
+    assert sent.after_id == 2
+    assert not sent.add(3)
@@ -0,0 +1,95 @@
+import httpx
+import pytest
+
+import auth
+import controllers
+import database
+import schemas
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def task_ids(databases) -> list[int]:
+    """Five tasks of the employee 1 and one of the employee 2"""
+    async with database.SessionLocal() as session_db:
+        results = await controllers.TaskController(session_db).create_many(
+            [schemas.TaskSchemaCreate(id_employee=1, last_context="", message_text=f"task {i}") for i in range(5)] +
+            [schemas.TaskSchemaCreate(id_employee=2, last_context="", message_text="other")])
+    return [result.id for result in results]
+
+
+async def claim(batch: int = 2, visibility_seconds: int = 60) -> schemas.TaskClaimSchema:
+    async with database.SessionLocal() as session_db:
+        return await controllers.TaskController(session_db).claim(1, batch, visibility_seconds)
+
+
+async def ack(claim_token: str, ids: list[int]) -> list[bool]:
+    async with database.SessionLocal() as session_db:
+        return [result.ok for result in await controllers.TaskController(session_db).ack(claim_token, ids)]
+
+
+async def nack(claim_token: str, ids: list[int], delay_seconds: int = 0) -> list[bool]:
+    async with database.SessionLocal() as session_db:
+        return [result.ok for result in
+                await controllers.TaskController(session_db).nack(claim_token, ids, delay_seconds)]
+
+
+async def test_claims_take_the_oldest_unclaimed_tasks_of_the_employee(task_ids):
+    first = await claim()
+    second = await claim()
+    assert [task.id for task in first.tasks] == task_ids[:2]
+    assert [task.id for task in second.tasks] == task_ids[2:4]
+    assert first.claim_token != second.claim_token
+    assert [task.id for task in (await claim(batch=10)).tasks] == task_ids[4:5]
+
+
+async def test_ack_deletes_only_the_tasks_of_its_claim(task_ids):
+    claimed = await claim()
+    assert await ack("wrong token", task_ids[:2]) == [False, False]
+    assert await ack(claimed.claim_token, task_ids[:3]) == [True, True, False]
+    assert await ack(claimed.claim_token, task_ids[:2]) == [False, False]
+    async with database.SessionLocal() as session_db:
+        assert [task.id for task in await controllers.TaskController(session_db).get(id_employee=1)] == task_ids[2:5]
+
+
+async def test_nack_returns_the_tasks_to_the_queue(task_ids):
+    claimed = await claim()
+    assert await nack("wrong token", task_ids[:2]) == [False, False]
+    assert await nack(claimed.claim_token, task_ids[:2]) == [True, True]
+    assert [task.id for task in (await claim()).tasks] == task_ids[:2]
+
+
+async def test_nack_with_delay_keeps_the_tasks_hidden(task_ids):
+    claimed = await claim()
+    assert await nack(claimed.claim_token, task_ids[:1], delay_seconds=60) == [True]
+    # The second task stays claimed by the first claim
+    assert [task.id for task in (await claim(batch=10)).tasks] == task_ids[2:5]
+
+
+async def test_expired_claim_is_taken_over_and_its_token_is_refused(task_ids):
+    expired = await claim(visibility_seconds=0)
+    taken_over = await claim()
+    assert [task.id for task in taken_over.tasks] == task_ids[:2]
+    assert await ack(expired.claim_token, task_ids[:2]) == [False, False]
+    assert await nack(expired.claim_token, task_ids[:2]) == [False, False]
+    assert await ack(taken_over.claim_token, task_ids[:2]) == [True, True]
+
+
+@pytest.mark.parametrize("delay_seconds", [-1, 10 ** 12])
+async def test_nack_delay_out_of_bounds_is_rejected(task_ids, monkeypatch, delay_seconds):
+    try:
+        import main
+    except ImportError as err:
+        # main imports pyodbc, which needs the ODBC driver manager library
+        pytest.skip(f"main can't be imported: {err}")
+
+    claimed = await claim()
+    monkeypatch.setitem(main.app.dependency_overrides, auth.check_active_user,
+                        lambda: schemas.UserSchema(user_name="bot", disabled=False, role="user", hashed_password=""))
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+        response = await client.post("/tasks/nack", json={"claim_token": claimed.claim_token,
+                                                          "ids": [task.id for task in claimed.tasks],
+                                                          "delay_seconds": delay_seconds})
+    assert response.status_code == 422
+    assert await ack(claimed.claim_token, [task.id for task in claimed.tasks]) == [True, True]